@@ -1,4 +1,3 @@
-import concurrent.futures
 import logging
 import os
 import sys
@@ -6,31 +5,55 @@ import time
 from pathlib import Path
 from typing import List
 
-import psutil
-
 from barks_fantagraphics.comics_cmd_args import CmdArgs, CmdArgNames
 from barks_fantagraphics.comics_consts import RESTORABLE_PAGE_TYPES
 from barks_fantagraphics.comics_utils import get_abbrev_path, setup_logging
-from src.restore_pipeline import RestorePipeline, check_for_errors
+from src.memory_admission import MemoryAdmission
+from src.page_scheduler import PageScheduler, PageStage
+from src.restore_pipeline import USE_STAGE_CACHE, RestorePipeline, PersistPolicy, check_for_errors
+from src.stage_trace import write_chrome_trace
 
 SCALE = 4
-SMALL_RAM = 16 * 1024 * 1024 * 1024
+# The restore parts run in separate processes so each part's final work file is needed.
+PERSIST_POLICY = PersistPolicy.FINAL_ONLY
+# Every stage of every page is traced to a json lines file in the work dir. A chrome trace
+# event version is written at the end for a timeline viewer such as https://ui.perfetto.dev.
+TRACE_RESTORE = True
+# Pages that have already been restored are run again, and the stage cache redoes only the
+# stages whose inputs, parameters or code have changed. Without the stage cache, or with
+# this off, restored pages are skipped.
+RERUN_RESTORED_PAGES = True
+# A restored page's '.npy' work files take around 1 GB at 4x, so a volume needs a few
+# hundred GB of work space if they're all kept. The stage cache needs them to skip the
+# early stages on a re-run. With this on they're removed as each page is restored, and a
+# re-run then redoes every stage, so only turn it on for a final run short of disk space.
+REMOVE_RESTORED_WORK_FILES = False
 
 
 def restore(title_list: List[str]) -> None:
     start = time.time()
 
+    # All the titles' pages are streamed through the restore stages together.
+    restore_processes: List[RestorePipeline] = []
     for title in title_list:
-        restore_title(title)
+        restore_processes.extend(get_title_restore_processes(title))
+
+    run_restore(restore_processes)
 
     logging.info(
-        f'\nTime taken to restore all {len(title_list)} titles": {int(time.time() - start)}s.'
+        f"\nTime taken to restore all {len(title_list)} titles"
+        f' ({len(restore_processes)} files)": {int(time.time() - start)}s.'
     )
 
+    if TRACE_RESTORE and os.path.isfile(trace_file):
+        chrome_trace_file = os.path.splitext(trace_file)[0] + "-chrome.json"
+        write_chrome_trace(trace_file, chrome_trace_file)
+        logging.info(f'Restore trace written to "{chrome_trace_file}".')
+
+    check_for_errors(restore_processes)
 
-def restore_title(title: str) -> None:
-    start = time.time()
 
+def get_title_restore_processes(title: str) -> List[RestorePipeline]:
     logging.info(f'Processing story "{title}".')
 
     comic = comics_database.get_comic_book(title)
@@ -66,7 +89,7 @@ def restore_title(title: str) -> None:
         if not os.path.isfile(srce_upscayl_file[0]):
             logging.error(f'Could not find srce upscayl file - skipping: "{srce_upscayl_file[0]}".')
             continue
-        if os.path.isfile(dest_restored_file):
+        if os.path.isfile(dest_restored_file) and not (RERUN_RESTORED_PAGES and USE_STAGE_CACHE):
             logging.warning(
                 f'Dest file exists - skipping: "{get_abbrev_path(dest_restored_file)}".'
             )
@@ -87,73 +110,109 @@ def restore_title(title: str) -> None:
                 Path(dest_restored_file),
                 Path(dest_upscayled_restored_file),
                 Path(dest_svg_restored_file),
+                PERSIST_POLICY,
+                trace_file if TRACE_RESTORE else "",
+                inpaint_threads=part4_inpaint_threads,
+                trace_workers=part3_trace_workers,
+                median_filter_threads=part1_median_filter_threads,
             )
         )
 
-    run_restore(restore_processes)
+    return restore_processes
 
-    logging.info(
-        f"\nTime taken to restore all {len(restore_processes)}"
-        f' title files": {int(time.time() - start)}s.'
-    )
 
-    check_for_errors(restore_processes)
+max_total_workers = 10
 
+# Stages are admitted by their measured peak memory growth per megapixel, on top of a worker
+# process's own memory (see 'MemoryAdmission'), so the part worker limits below are upper
+# bounds. These rough figures are only used for a part until its first page is measured.
+DEFAULT_PART_MB_PER_MPIXEL = {
+    "part1": 40.0,
+    "part2": 120.0,
+    "part3": 30.0,
+    "part4": 120.0,
+}
+MEMORY_STATS_FILENAME = "restore-memory-stats.json"
 
 part1_max_workers = 10
+# Share the cores between the pages median filtered at once.
+part1_median_filter_threads = max(1, os.cpu_count() // part1_max_workers)
 
 
-def run_restore_part1(proc: RestorePipeline):
+def run_restore_part1(proc: RestorePipeline) -> bool:
     logging.info(f'Starting restore part 1 for "{proc.srce_file.name}".')
     proc.do_part1()
+    return proc.errors_occurred
 
 
-part2_max_workers = 1 if psutil.virtual_memory().total < SMALL_RAM else 3
+part2_max_workers = 4
 
 
-def run_restore_part2(proc: RestorePipeline):
+def run_restore_part2(proc: RestorePipeline) -> bool:
     logging.info(f'Starting restore part 2 for "{proc.srce_file.name}".')
     proc.do_part2_memory_hungry()
+    return proc.errors_occurred
 
 
 part3_max_workers = 10
+# Share the cores between the pages traced at once.
+part3_trace_workers = max(1, os.cpu_count() // part3_max_workers)
 
 
-def run_restore_part3(proc: RestorePipeline):
+def run_restore_part3(proc: RestorePipeline) -> bool:
     logging.info(f'Starting restore part 3 for "{proc.srce_file.name}".')
     proc.do_part3()
+    return proc.errors_occurred
 
 
-part4_max_workers = 1 if psutil.virtual_memory().total < SMALL_RAM else 2
+part4_max_workers = 4
+# Share the cores between the pages inpainted at once.
+part4_inpaint_threads = max(1, os.cpu_count() // part4_max_workers)
 
 
-def run_restore_part4(proc: RestorePipeline):
+def run_restore_part4(proc: RestorePipeline) -> bool:
     logging.info(f'Starting restore part 4 for "{proc.srce_file.name}".')
     proc.do_part4_memory_hungry()
+    return proc.errors_occurred
 
 
 def run_restore(restore_processes: List[RestorePipeline]) -> None:
     logging.info(f"Starting restore for {len(restore_processes)} processes.")
 
-    with concurrent.futures.ProcessPoolExecutor(part1_max_workers) as executor:
-        for process in restore_processes:
-            executor.submit(run_restore_part1, process)
+    # Inpainting (part 4) only needs part 1, but the overlay needs the svg from part 3.
+    stages = [
+        PageStage("part1", run_restore_part1, part1_max_workers, []),
+        PageStage("part2", run_restore_part2, part2_max_workers, ["part1"]),
+        PageStage("part3", run_restore_part3, part3_max_workers, ["part2"]),
+        PageStage("part4", run_restore_part4, part4_max_workers, ["part1", "part3"]),
+    ]
+
+    admission = MemoryAdmission(
+        os.path.join(work_dir, MEMORY_STATS_FILENAME), DEFAULT_PART_MB_PER_MPIXEL
+    )
+    scheduler = PageScheduler(
+        stages,
+        max_total_workers,
+        on_restore_part_done,
+        admission,
+        RestorePipeline.get_megapixels,
+    )
+    for proc, stage_name in scheduler.run(restore_processes):
+        logging.error(f'Restore {stage_name} failed for "{proc.srce_file.name}".')
+        proc.errors_occurred = True
 
-    with concurrent.futures.ProcessPoolExecutor(part2_max_workers) as executor:
-        for process in restore_processes:
-            executor.submit(run_restore_part2, process)
 
-    with concurrent.futures.ProcessPoolExecutor(part3_max_workers) as executor:
-        for process in restore_processes:
-            executor.submit(run_restore_part3, process)
+def on_restore_part_done(proc: RestorePipeline, stage_name: str, errors_occurred: bool) -> None:
+    # The parts run on copies of 'proc' in worker processes.
+    proc.errors_occurred = proc.errors_occurred or errors_occurred
 
-    with concurrent.futures.ProcessPoolExecutor(part4_max_workers) as executor:
-        for process in restore_processes:
-            executor.submit(run_restore_part4, process)
+    if stage_name == "part4" and REMOVE_RESTORED_WORK_FILES and not proc.errors_occurred:
+        proc.remove_work_files()
 
 
 work_dir = os.path.join("/mnt/2tb_drive/workdir/barks-restore")
 os.makedirs(work_dir, exist_ok=True)
+trace_file = os.path.join(work_dir, f"restore-trace-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
 
 setup_logging(logging.INFO)
 
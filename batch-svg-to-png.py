@@ -24,6 +24,8 @@ def svgs_to_pngs(title_list: List[str]) -> None:
 
         srce_files = comic.get_srce_restored_svg_story_files(RESTORABLE_PAGE_TYPES)
 
+        # Whole files in parallel, each rendered in one pass. Banded rendering parses the
+        # svg once per band, so it costs more cpu per file.
         with concurrent.futures.ProcessPoolExecutor() as executor:
             for srce_file in srce_files:
                 executor.submit(convert_svg_to_png, srce_file)
@@ -47,7 +49,7 @@ def convert_svg_to_png(srce_svg: str) -> None:
             f'Converting svg file "{get_abbrev_path(srce_svg)}"'
             f' to dest png "{get_abbrev_path(png_file)}".'
         )
-        svg_file_to_png(srce_svg, png_file)
+        svg_file_to_png(srce_svg, png_file, num_workers=1)
 
     except Exception as e:
         logging.error(f"Error: {e}")
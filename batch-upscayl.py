@@ -7,9 +7,12 @@ from typing import List
 from barks_fantagraphics.comics_cmd_args import CmdArgs, CmdArgNames
 from barks_fantagraphics.comics_consts import RESTORABLE_PAGE_TYPES
 from barks_fantagraphics.comics_utils import get_abbrev_path, setup_logging
+from src.stage_trace import trace_stage, write_chrome_trace
 from src.upscale_image import upscale_image_file
 
 SCALE = 4
+TRACE_UPSCAYL = True
+TRACE_DIR = "/mnt/2tb_drive/workdir/barks-restore"
 
 
 def upscayl(title_list: List[str]) -> None:
@@ -32,6 +35,11 @@ def upscayl(title_list: List[str]) -> None:
         f"\nTime taken to upscayl all {num_upscayled_files} files: {int(time.time() - start)}s."
     )
 
+    if TRACE_UPSCAYL and os.path.isfile(trace_file):
+        chrome_trace_file = os.path.splitext(trace_file)[0] + "-chrome.json"
+        write_chrome_trace(trace_file, chrome_trace_file)
+        logging.info(f'Upscayl trace written to "{chrome_trace_file}".')
+
 
 def upscayl_file(srce_file: str, dest_file: str) -> bool:
     if not os.path.isfile(srce_file):
@@ -46,13 +54,18 @@ def upscayl_file(srce_file: str, dest_file: str) -> bool:
         f'Upscayling srce file "{get_abbrev_path(srce_file)}"'
         f' to dest upscayl file "{get_abbrev_path(dest_file)}".'
     )
-    upscale_image_file(srce_file, dest_file, SCALE)
+    with trace_stage(trace_file if TRACE_UPSCAYL else "", "upscayl", os.path.basename(srce_file)):
+        upscale_image_file(srce_file, dest_file, SCALE)
 
     logging.info(f"\nTime taken to upscayl file: {int(time.time() - start)}s.")
 
     return True
 
 
+if TRACE_UPSCAYL:
+    os.makedirs(TRACE_DIR, exist_ok=True)
+trace_file = os.path.join(TRACE_DIR, f"upscayl-trace-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+
 setup_logging(logging.INFO)
 
 cmd_args = CmdArgs("Upscayl volume titles", CmdArgNames.TITLE | CmdArgNames.VOLUME)
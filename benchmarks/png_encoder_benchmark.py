@@ -0,0 +1,67 @@
+# Compare the parallel png encoder with the PIL 'optimize=True' path for a synthetic
+# deliverable sized page. Run from the repo root:
+#
+#   python -m benchmarks.png_encoder_benchmark --out-dir /tmp/barks-bench
+
+import argparse
+import logging
+import os
+import time
+
+import cv2 as cv
+import numpy as np
+from PIL import Image
+
+from benchmarks.synthetic_pages import PAGE_HEIGHT, PAGE_WIDTH, get_synthetic_page
+from benchmarks.synthetic_pages import get_upscaled_page
+from src.png_encoder import PNG_ENCODE_THREADS, write_png
+
+PNG_COMPRESSION = 9
+
+
+def run_png_encoder_benchmark(out_dir: str, width: int, height: int, scale: int, threads: int):
+    page = get_upscaled_page(get_synthetic_page(1, width, height), scale)
+    rgb_page = cv.cvtColor(page, cv.COLOR_BGR2RGB)
+    text = {"BARKS:Benchmark": "true"}
+    logging.info(f"Encoding a {rgb_page.shape[1]}x{rgb_page.shape[0]} page.")
+
+    pil_file = os.path.join(out_dir, "pil-encoded.png")
+    start = time.perf_counter()
+    Image.fromarray(rgb_page).save(pil_file, optimize=True, compress_level=PNG_COMPRESSION)
+    pil_secs = time.perf_counter() - start
+
+    parallel_file = os.path.join(out_dir, "parallel-encoded.png")
+    start = time.perf_counter()
+    write_png(parallel_file, rgb_page, text, PNG_COMPRESSION, threads)
+    parallel_secs = time.perf_counter() - start
+
+    with Image.open(parallel_file) as parallel_image:
+        if not np.array_equal(np.asarray(parallel_image), rgb_page):
+            raise Exception("The parallel encoded png does not decode to the input image.")
+        if parallel_image.text != text:
+            raise Exception(f"The parallel encoded png has the wrong text: {parallel_image.text}.")
+
+    logging.info(f"PIL: {pil_secs:.2f}s, {os.path.getsize(pil_file)} bytes.")
+    logging.info(
+        f"Parallel ({threads} threads): {parallel_secs:.2f}s,"
+        f" {os.path.getsize(parallel_file)} bytes ({pil_secs / parallel_secs:.2f}x faster)."
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser(description="Benchmark the parallel png encoder.")
+    parser.add_argument("--out-dir", required=True, help="Directory for the encoded files.")
+    parser.add_argument("--width", type=int, default=PAGE_WIDTH)
+    parser.add_argument("--height", type=int, default=PAGE_HEIGHT)
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=PNG_ENCODE_THREADS)
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    run_png_encoder_benchmark(args.out_dir, args.width, args.height, args.scale, args.threads)
@@ -0,0 +1,250 @@
+# Time each restore stage and the whole RestorePipeline on synthetic pages, so performance
+# changes can be checked without the Fantagraphics scans. Run from the repo root:
+#
+#   python -m benchmarks.run_benchmarks --out-dir /tmp/barks-bench --results results.json
+#   python -m benchmarks.run_benchmarks --out-dir /tmp/barks-bench --baseline results.json
+#
+# Each stage reads the previous stage's output file, as the single stage scripts do.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import cv2 as cv
+
+from benchmarks.synthetic_pages import PAGE_HEIGHT, PAGE_WIDTH, get_synthetic_page
+from benchmarks.synthetic_pages import get_upscaled_page
+from src.image_io import resize_image_file, svg_file_to_png
+from src.ink_mask import get_ink_mask_from_svg_file
+from src.inpaint import inpaint_image_file
+from src.overlay import overlay_inpainted_file_with_black_ink
+from src.remove_alias_artifacts import get_median_filter
+from src.remove_colors import get_colors_removed_image, remove_colors_from_image
+from src.restore_pipeline import RestorePipeline
+from src.smooth_image import smooth_image_file
+from src.vtracer_to_svg import image_file_to_svg
+
+BENCHMARK_RESULTS_VERSION = 1
+DEFAULT_SCALE = 4
+DEFAULT_REPEAT = 3
+DEFAULT_SEED = 1
+# A stage is reported as a regression if it's this much slower than the baseline.
+DEFAULT_MAX_REGRESSION = 0.1
+
+JIT_WARM_UP_SIZE = 256
+
+
+class StageFiles:
+    def __init__(self, out_dir: str, scale: int):
+        self.out_dir = out_dir
+        self.work_dir = os.path.join(out_dir, "work")
+        self.stem = "page"
+        self.scale = scale
+
+        self.srce_file = os.path.join(out_dir, f"{self.stem}.jpg")
+        self.upscaled_file = os.path.join(out_dir, f"{self.stem}-upscayled.png")
+        self.median_filtered_file = os.path.join(out_dir, f"{self.stem}-median-filtered.png")
+        self.removed_colors_file = os.path.join(out_dir, f"{self.stem}-color-removed.png")
+        self.smoothed_file = os.path.join(out_dir, f"{self.stem}-color-removed-smoothed.png")
+        self.svg_file = os.path.join(out_dir, f"{self.stem}.svg")
+        self.png_of_svg_file = self.svg_file + ".png"
+        self.inpainted_file = os.path.join(out_dir, f"{self.stem}-inpainted.png")
+        self.upscayled_restored_file = os.path.join(out_dir, f"{self.stem}-upscayled-restored.png")
+        self.restored_file = os.path.join(out_dir, f"{self.stem}-restored.png")
+
+
+def run_benchmarks(
+    out_dir: str, width: int, height: int, scale: int, seed: int, repeat: int
+) -> Dict[str, Any]:
+    files = StageFiles(out_dir, scale)
+    os.makedirs(files.work_dir, exist_ok=True)
+
+    logging.info(f"Generating {width}x{height} synthetic page upscaled {scale}x...")
+    page = get_synthetic_page(seed, width, height)
+    cv.imwrite(files.srce_file, page)
+    cv.imwrite(files.upscaled_file, get_upscaled_page(page, scale))
+
+    _warm_up_jit()
+
+    stages: Dict[str, Callable[[], None]] = {
+        "get_median_filter": lambda: _median_filter_file(files),
+        "remove_colors_from_image": lambda: remove_colors_from_image(
+            files.work_dir, files.stem, files.median_filtered_file, files.removed_colors_file
+        ),
+        "smooth_image_file": lambda: smooth_image_file(
+            files.removed_colors_file, files.smoothed_file
+        ),
+        "image_file_to_svg": lambda: image_file_to_svg(files.smoothed_file, files.svg_file),
+        "svg_file_to_png": lambda: svg_file_to_png(files.svg_file, files.png_of_svg_file),
+        "get_ink_mask_from_svg_file": lambda: get_ink_mask_from_svg_file(files.svg_file),
+        "inpaint_image_file": lambda: inpaint_image_file(
+            files.work_dir,
+            files.stem,
+            files.upscaled_file,
+            files.removed_colors_file,
+            files.inpainted_file,
+        ),
+        "overlay_inpainted_file_with_black_ink": lambda: overlay_inpainted_file_with_black_ink(
+            files.inpainted_file, files.png_of_svg_file, files.upscayled_restored_file
+        ),
+        "resize_image_file": lambda: resize_image_file(
+            files.upscayled_restored_file, scale, files.restored_file, {"Benchmark": "true"}
+        ),
+        "restore_pipeline": lambda: _run_restore_pipeline(files),
+    }
+
+    stage_results = dict()
+    for stage_name, stage_func in stages.items():
+        run_secs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            stage_func()
+            run_secs.append(time.perf_counter() - start)
+
+        stage_results[stage_name] = {
+            "min_secs": min(run_secs),
+            "median_secs": statistics.median(run_secs),
+            "runs": run_secs,
+        }
+        logging.info(f'Stage "{stage_name}": {min(run_secs):.2f}s (min of {repeat}).')
+
+    return {
+        "version": BENCHMARK_RESULTS_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+        },
+        "config": {"width": width, "height": height, "scale": scale, "seed": seed},
+        "stages": stage_results,
+    }
+
+
+# Compile the numba kernels so the first timed run doesn't include the jit time.
+def _warm_up_jit():
+    page = get_synthetic_page(0, JIT_WARM_UP_SIZE, JIT_WARM_UP_SIZE)
+    get_colors_removed_image("", "", get_median_filter(page), False)
+
+
+def _median_filter_file(files: StageFiles):
+    out_image = get_median_filter(cv.imread(files.upscaled_file))
+    cv.imwrite(files.median_filtered_file, out_image)
+
+
+# A fresh work dir each run so the stage cache doesn't skip anything.
+def _run_restore_pipeline(files: StageFiles):
+    work_dir = os.path.join(files.out_dir, "restore-pipeline-work")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+
+    out_dir = os.path.join(files.out_dir, "restore-pipeline-out")
+    os.makedirs(out_dir, exist_ok=True)
+
+    restore_process = RestorePipeline(
+        work_dir,
+        Path(files.srce_file),
+        Path(files.upscaled_file),
+        files.scale,
+        Path(os.path.join(out_dir, os.path.basename(files.restored_file))),
+        Path(os.path.join(out_dir, os.path.basename(files.upscayled_restored_file))),
+        Path(os.path.join(out_dir, os.path.basename(files.svg_file))),
+    )
+    restore_process.do_part1()
+    restore_process.do_part2_memory_hungry()
+    restore_process.do_part3()
+    restore_process.do_part4_memory_hungry()
+
+    if restore_process.errors_occurred:
+        raise Exception("There were errors running the restore pipeline.")
+
+
+# Return the names of the stages that are slower than the baseline by more than
+# 'max_regression'.
+def compare_with_baseline(
+    results: Dict[str, Any], baseline: Dict[str, Any], max_regression: float
+) -> List[str]:
+    if results["config"] != baseline["config"]:
+        logging.warning(
+            f"Benchmark config {results['config']} differs from baseline {baseline['config']}."
+        )
+
+    regressions = []
+    for stage_name, stage_result in results["stages"].items():
+        if stage_name not in baseline["stages"]:
+            logging.info(f'Stage "{stage_name}": not in baseline.')
+            continue
+
+        baseline_secs = baseline["stages"][stage_name]["min_secs"]
+        secs = stage_result["min_secs"]
+        ratio = secs / baseline_secs if baseline_secs > 0 else 1.0
+
+        is_regression = ratio > 1.0 + max_regression
+        if is_regression:
+            regressions.append(stage_name)
+
+        logging.info(
+            f'Stage "{stage_name}": {secs:.2f}s vs baseline {baseline_secs:.2f}s'
+            f" ({ratio:.2f}x){' - REGRESSION' if is_regression else ''}."
+        )
+
+    return regressions
+
+
+# The same rule as the pipeline's downscale of the restored image.
+def _get_scale_arg(value: str) -> int:
+    scale = int(value)
+    if scale < 1:
+        raise argparse.ArgumentTypeError(f"The scale must be a whole number of at least 1: {value}")
+
+    return scale
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the restore stages.")
+    parser.add_argument("--out-dir", required=True, help="Directory for the benchmark files.")
+    parser.add_argument("--results", help="Json file to write the results to.")
+    parser.add_argument("--baseline", help="Json results file to compare against.")
+    parser.add_argument("--width", type=int, default=PAGE_WIDTH)
+    parser.add_argument("--height", type=int, default=PAGE_HEIGHT)
+    parser.add_argument("--scale", type=_get_scale_arg, default=DEFAULT_SCALE)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--max-regression", type=float, default=DEFAULT_MAX_REGRESSION)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    args = get_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    benchmark_results = run_benchmarks(
+        args.out_dir, args.width, args.height, args.scale, args.seed, args.repeat
+    )
+
+    if args.results:
+        with open(args.results, "w") as f:
+            json.dump(benchmark_results, f, indent=4)
+        logging.info(f'Benchmark results written to "{args.results}".')
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline_results = json.load(f)
+        if compare_with_baseline(benchmark_results, baseline_results, args.max_regression):
+            sys.exit(1)
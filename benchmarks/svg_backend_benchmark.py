@@ -0,0 +1,133 @@
+# Compare the potrace and vtracer svg backends on the ink of a synthetic page, and the
+# ways of rasterizing the svgs. Run from the repo root:
+#
+#   python -m benchmarks.svg_backend_benchmark --out-dir /tmp/barks-bench
+#
+# potrace is pure python, so keep the page small.
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import time
+from typing import Callable, Tuple
+
+import cv2 as cv
+
+from benchmarks.synthetic_pages import get_synthetic_page, get_upscaled_page
+from src.potrace_to_svg import image_to_svg_file
+from src.remove_colors import get_colors_removed_image
+from src.svg_raster import SVG_RASTER_WORKERS, get_svg_image
+from src.vtracer_to_svg import image_to_svg
+
+DEFAULT_WIDTH = 1000
+DEFAULT_HEIGHT = 1350
+# Pages rasterized for the batch throughput numbers, as batch-svg-to-png.py does a title.
+DEFAULT_RASTER_FILES = 8
+
+
+def run_svg_backend_benchmark(
+    out_dir: str, width: int, height: int, scale: int, num_raster_files: int, band_workers: int
+):
+    page = get_upscaled_page(get_synthetic_page(1, width, height), scale)
+    removed_colors_image = get_colors_removed_image("", "", page, False)
+    ink_image = cv.cvtColor(removed_colors_image, cv.COLOR_BGRA2GRAY)
+    ink = ink_image < 128
+    logging.info(f"Tracing the ink of a {ink.shape[1]}x{ink.shape[0]} page.")
+
+    vtracer_file = os.path.join(out_dir, "vtracer.svg")
+    start = time.perf_counter()
+    vtracer_svg = image_to_svg(ink)
+    with open(vtracer_file, "w") as f:
+        f.write(vtracer_svg.svg)
+    vtracer_secs = time.perf_counter() - start
+
+    potrace_file = os.path.join(out_dir, "potrace.svg")
+    potrace_svg = image_to_svg_file(ink, potrace_file)
+    potrace_secs = potrace_svg.trace_secs + potrace_svg.write_secs
+
+    logging.info(
+        f"vtracer: {vtracer_secs:.2f}s, {vtracer_svg.num_paths} paths,"
+        f" {os.path.getsize(vtracer_file)} bytes."
+    )
+    logging.info(
+        f"potrace: {potrace_secs:.2f}s (writing {potrace_svg.write_secs:.2f}s),"
+        f" {potrace_svg.num_curves} curves, {os.path.getsize(potrace_file)} bytes."
+    )
+
+    for svg_file in [vtracer_file, potrace_file]:
+        run_svg_raster_benchmark(svg_file, num_raster_files, band_workers)
+
+
+# Wall and cpu time (this process and its finished child processes) for one page rendered
+# in one pass and as parallel bands, and for a batch of pages rendered whole in parallel
+# and one after the other as parallel bands.
+def run_svg_raster_benchmark(svg_file: str, num_files: int, band_workers: int):
+    name = os.path.basename(svg_file)
+
+    whole_secs, whole_cpu_secs = _get_wall_and_cpu_secs(lambda: get_svg_image(svg_file, 1))
+    banded_secs, banded_cpu_secs = _get_wall_and_cpu_secs(
+        lambda: _render_banded_svg(svg_file, band_workers)
+    )
+    logging.info(
+        f"{name} raster: one pass {whole_secs:.2f}s (cpu {whole_cpu_secs:.2f}s),"
+        f" {band_workers} band workers {banded_secs:.2f}s (cpu {banded_cpu_secs:.2f}s)."
+    )
+
+    def render_files_in_parallel():
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            list(executor.map(_render_whole_svg, [svg_file] * num_files))
+
+    def render_files_as_bands():
+        for _ in range(num_files):
+            _render_banded_svg(svg_file, band_workers)
+
+    files_secs, files_cpu_secs = _get_wall_and_cpu_secs(render_files_in_parallel)
+    bands_secs, bands_cpu_secs = _get_wall_and_cpu_secs(render_files_as_bands)
+    logging.info(
+        f"{name} raster of {num_files} files: files in parallel {files_secs:.2f}s"
+        f" (cpu {files_cpu_secs:.2f}s), files as parallel bands {bands_secs:.2f}s"
+        f" (cpu {bands_cpu_secs:.2f}s)."
+    )
+
+
+def _render_whole_svg(svg_file: str):
+    get_svg_image(svg_file, 1)
+
+
+def _render_banded_svg(svg_file: str, num_workers: int):
+    get_svg_image(svg_file, num_workers, use_bands=True)
+
+
+def _get_wall_and_cpu_secs(func: Callable[[], None]) -> Tuple[float, float]:
+    start_times = os.times()
+    start = time.perf_counter()
+    func()
+    secs = time.perf_counter() - start
+    end_times = os.times()
+
+    cpu_secs = sum(end_times[:4]) - sum(start_times[:4])
+
+    return secs, cpu_secs
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser(description="Benchmark the potrace and vtracer backends.")
+    parser.add_argument("--out-dir", required=True, help="Directory for the svg files.")
+    parser.add_argument("--width", type=int, default=DEFAULT_WIDTH)
+    parser.add_argument("--height", type=int, default=DEFAULT_HEIGHT)
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--raster-files", type=int, default=DEFAULT_RASTER_FILES)
+    parser.add_argument("--band-workers", type=int, default=SVG_RASTER_WORKERS)
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    run_svg_backend_benchmark(
+        args.out_dir, args.width, args.height, args.scale, args.raster_files, args.band_workers
+    )
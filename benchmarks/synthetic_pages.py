@@ -0,0 +1,105 @@
+from typing import List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+# Roughly a Fantagraphics page scan before upscaling.
+PAGE_WIDTH = 2000
+PAGE_HEIGHT = 2700
+PAGE_JPEG_QUALITY = 85
+
+PAPER_COLOR = (226, 240, 246)  # BGR
+INK_COLOR = (18, 16, 20)
+FLAT_COLORS = [
+    (70, 160, 235),
+    (60, 60, 200),
+    (200, 120, 60),
+    (120, 200, 240),
+    (90, 170, 90),
+    (170, 200, 230),
+    (40, 110, 190),
+    (210, 190, 150),
+]
+
+PANEL_ROWS = 4
+PANEL_COLS = 2
+# As fractions of the page width.
+PANEL_GUTTER = 0.015
+PAGE_MARGIN = 0.04
+NUM_SHAPES_PER_PANEL = 12
+NUM_STROKES_PER_PANEL = 40
+NUM_TEXT_LINES_PER_PANEL = 3
+
+
+# Make a synthetic Barks style page: panels with flat colored shapes outlined in black ink,
+# hatching strokes and lettering blobs on off-white paper, saved and re-read as a jpeg so it
+# has the compression artifacts of the real scans.
+def get_synthetic_page(
+    seed: int, width: int = PAGE_WIDTH, height: int = PAGE_HEIGHT
+) -> cv.typing.MatLike:
+    rng = np.random.default_rng(seed)
+    page = np.full((height, width, 3), PAPER_COLOR, dtype=np.uint8)
+
+    for x0, y0, x1, y1 in _get_panel_boxes(width, height):
+        _draw_panel(rng, page, x0, y0, x1, y1)
+
+    ok, jpeg = cv.imencode(".jpg", page, [cv.IMWRITE_JPEG_QUALITY, PAGE_JPEG_QUALITY])
+    if not ok:
+        raise Exception("Could not jpeg encode synthetic page.")
+
+    return cv.imdecode(jpeg, cv.IMREAD_COLOR)
+
+
+# Stands in for upscayl, which is not needed to benchmark the restore stages.
+def get_upscaled_page(page: cv.typing.MatLike, scale: int) -> cv.typing.MatLike:
+    return cv.resize(page, (0, 0), fx=scale, fy=scale, interpolation=cv.INTER_CUBIC)
+
+
+def _get_panel_boxes(width: int, height: int) -> List[Tuple[int, int, int, int]]:
+    margin = int(PAGE_MARGIN * width)
+    gutter = int(PANEL_GUTTER * width)
+    panel_width = (width - 2 * margin - (PANEL_COLS - 1) * gutter) // PANEL_COLS
+    panel_height = (height - 2 * margin - (PANEL_ROWS - 1) * gutter) // PANEL_ROWS
+
+    boxes = []
+    for row in range(PANEL_ROWS):
+        for col in range(PANEL_COLS):
+            x0 = margin + col * (panel_width + gutter)
+            y0 = margin + row * (panel_height + gutter)
+            boxes.append((x0, y0, x0 + panel_width, y0 + panel_height))
+
+    return boxes
+
+
+def _draw_panel(rng: np.random.Generator, page: cv.typing.MatLike, x0, y0, x1, y1):
+    panel = page[y0:y1, x0:x1]
+    panel_height, panel_width = panel.shape[:2]
+
+    panel[:] = FLAT_COLORS[rng.integers(len(FLAT_COLORS))]
+
+    for _ in range(NUM_SHAPES_PER_PANEL):
+        color = FLAT_COLORS[rng.integers(len(FLAT_COLORS))]
+        center = (int(rng.integers(panel_width)), int(rng.integers(panel_height)))
+        axes = (
+            int(rng.integers(2, max(3, panel_width // 4))),
+            int(rng.integers(2, max(3, panel_height // 4))),
+        )
+        angle = float(rng.uniform(0, 180))
+        cv.ellipse(panel, center, axes, angle, 0, 360, color, -1, cv.LINE_AA)
+        cv.ellipse(
+            panel, center, axes, angle, 0, 360, INK_COLOR, int(rng.integers(2, 6)), cv.LINE_AA
+        )
+
+    for _ in range(NUM_STROKES_PER_PANEL):
+        points = rng.integers(0, [panel_width, panel_height], size=(4, 2)).astype(np.int32)
+        cv.polylines(panel, [points], False, INK_COLOR, int(rng.integers(1, 4)), cv.LINE_AA)
+
+    for line in range(NUM_TEXT_LINES_PER_PANEL):
+        y = 20 + line * 22
+        x = 20
+        while x < panel_width // 2:
+            letter_width = int(rng.integers(6, 12))
+            cv.rectangle(panel, (x, y), (x + letter_width, y + 14), INK_COLOR, 2)
+            x += letter_width + int(rng.integers(3, 10))
+
+    cv.rectangle(panel, (0, 0), (panel_width - 1, panel_height - 1), INK_COLOR, 4)
@@ -0,0 +1,7 @@
+import numba
+
+# The stages fork process pools, and a process that has run a parallel loop on numba's TBB
+# threading layer hangs at exit once it has forked. The parallel loops are only ever run
+# from one thread at a time, so use the fork safe workqueue layer for all of them. This
+# has to be set before the first parallel loop runs.
+numba.config.THREADING_LAYER = "workqueue"
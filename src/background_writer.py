@@ -0,0 +1,80 @@
+import concurrent.futures
+import logging
+import os
+import threading
+from typing import Any, Callable, List, Optional
+
+USE_BACKGROUND_WRITER = True
+BACKGROUND_WRITER_THREADS = 2
+# Submitting blocks while more than this is queued, so arrays waiting to be written can't
+# pile up in memory. A single larger write is still accepted when the queue is empty.
+BACKGROUND_WRITER_MAX_QUEUED_BYTES = 1024 * 1024 * 1024
+
+
+# Runs file writes (debug images, color counts, etc.) in its own threads so stages can carry
+# on computing. Whatever is handed to 'submit' must not be changed afterwards. Call 'wait'
+# when the files are needed - it raises if any write failed.
+class BackgroundWriter:
+    def __init__(
+        self,
+        num_threads: int = BACKGROUND_WRITER_THREADS,
+        max_queued_bytes: int = BACKGROUND_WRITER_MAX_QUEUED_BYTES,
+    ):
+        self.max_queued_bytes = max_queued_bytes
+        self.queued_bytes = 0
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            num_threads, thread_name_prefix="background-writer"
+        )
+        self._futures: List[concurrent.futures.Future] = []
+        self._queue_changed = threading.Condition()
+
+    def submit(self, num_bytes: int, write_func: Callable[..., Any], *args, **kwargs):
+        if not USE_BACKGROUND_WRITER:
+            write_func(*args, **kwargs)
+            return
+
+        with self._queue_changed:
+            self._queue_changed.wait_for(
+                lambda: self.queued_bytes == 0
+                or self.queued_bytes + num_bytes <= self.max_queued_bytes
+            )
+            self.queued_bytes += num_bytes
+
+        future = self._executor.submit(write_func, *args, **kwargs)
+        future.add_done_callback(lambda _: self._release(num_bytes))
+        self._futures.append(future)
+
+    def _release(self, num_bytes: int):
+        with self._queue_changed:
+            self.queued_bytes -= num_bytes
+            self._queue_changed.notify_all()
+
+    def wait(self):
+        futures = self._futures
+        self._futures = []
+
+        errors = []
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception():
+                logging.error(f"Background write failed: {future.exception()}")
+                errors.append(future.exception())
+
+        if errors:
+            raise Exception(f"{len(errors)} background write(s) failed.") from errors[0]
+
+
+_background_writer: Optional[BackgroundWriter] = None
+_background_writer_pid = 0
+
+
+# One writer per process. A writer inherited through a fork has no threads, so a child
+# process gets its own.
+def get_background_writer() -> BackgroundWriter:
+    global _background_writer, _background_writer_pid
+
+    if _background_writer is None or _background_writer_pid != os.getpid():
+        _background_writer = BackgroundWriter()
+        _background_writer_pid = os.getpid()
+
+    return _background_writer
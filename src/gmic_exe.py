@@ -1,7 +1,23 @@
 import logging
+import os
 import subprocess
+import tempfile
 from typing import List
 
+import cv2 as cv
+import numpy as np
+
+try:
+    import gmic
+except ImportError:
+    gmic = None
+
+# Run gmic commands on in memory images with the gmic python module when it's installed,
+# otherwise fall back to running the gmic cli on temporary files.
+USE_GMIC_PYTHON = True
+
+GMIC_TEMP_PNG_COMPRESSION = 1
+
 
 def run_gmic(params: List[str]) -> None:
     gmic_path = "gmic"
@@ -22,3 +38,67 @@ def run_gmic(params: List[str]) -> None:
     rc = process.poll()
     if rc != 0:
         raise Exception("Gmic failed.")
+
+
+# Run the gmic commands 'params' on the input images and return the last image in the
+# resulting gmic image list. Images are uint8 opencv images (gray, BGR or BGRA).
+def run_gmic_on_images(params: List[str], images: List[cv.typing.MatLike]) -> cv.typing.MatLike:
+    if USE_GMIC_PYTHON and gmic is not None:
+        return _run_gmic_in_process(params, images)
+
+    return _run_gmic_with_files(params, images)
+
+
+def _run_gmic_in_process(params: List[str], images: List[cv.typing.MatLike]) -> cv.typing.MatLike:
+    gmic_cmd = " ".join(params)
+    logging.debug(f"Running gmic in process: {gmic_cmd}.")
+
+    gmic_images = gmic.ImageList([gmic.Image.from_yxc(_to_gmic_channels(im)) for im in images])
+    gmic_images = gmic.run(gmic_cmd, gmic_images)
+    if len(gmic_images) == 0:
+        raise Exception("Gmic returned no images.")
+
+    # The gmic floats are clamped and truncated to uint8 - the same as a gmic png output.
+    out_image = np.asarray(gmic_images[len(gmic_images) - 1].yxc)
+
+    return _from_gmic_channels(out_image)
+
+
+def _run_gmic_with_files(params: List[str], images: List[cv.typing.MatLike]) -> cv.typing.MatLike:
+    with tempfile.TemporaryDirectory(prefix="gmic-") as temp_dir:
+        in_files = []
+        for i, image in enumerate(images):
+            in_file = os.path.join(temp_dir, f"in-{i}.png")
+            cv.imwrite(in_file, image, [cv.IMWRITE_PNG_COMPRESSION, GMIC_TEMP_PNG_COMPRESSION])
+            in_files.append(in_file)
+
+        out_file = os.path.join(temp_dir, "out.png")
+        run_gmic(in_files + params + ["output[-1]", out_file])
+
+        out_image = cv.imread(out_file, cv.IMREAD_UNCHANGED)
+        if out_image is None:
+            raise Exception(f'Could not read gmic output file "{out_file}".')
+
+        return out_image
+
+
+def _to_gmic_channels(image: cv.typing.MatLike) -> cv.typing.MatLike:
+    if image.ndim == 2:
+        return image[:, :, np.newaxis]
+    if image.shape[2] == 3:
+        return cv.cvtColor(image, cv.COLOR_BGR2RGB)
+    if image.shape[2] == 4:
+        return cv.cvtColor(image, cv.COLOR_BGRA2RGBA)
+
+    return image
+
+
+def _from_gmic_channels(image: np.ndarray) -> cv.typing.MatLike:
+    if image.shape[2] == 1:
+        return np.ascontiguousarray(image[:, :, 0])
+    if image.shape[2] == 3:
+        return cv.cvtColor(image, cv.COLOR_RGB2BGR)
+    if image.shape[2] == 4:
+        return cv.cvtColor(image, cv.COLOR_RGBA2BGRA)
+
+    return np.ascontiguousarray(image)
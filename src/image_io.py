@@ -1,9 +1,9 @@
 import os
-from io import BytesIO
-from typing import List, Dict
+from enum import Enum, auto
+from typing import List, Dict, Tuple
 
-import cairosvg
 import cv2 as cv
+import numpy as np
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 
@@ -12,72 +12,142 @@ from barks_fantagraphics.comics_image_io import (
     SAVE_PNG_COMPRESSION,
     SAVE_JPG_QUALITY,
     SAVE_JPG_COMPRESS_LEVEL,
-    add_png_metadata,
 )
 from barks_fantagraphics.comics_info import JPG_FILE_EXT, PNG_FILE_EXT
-from .gmic_exe import run_gmic
+from .png_encoder import write_png
+from .svg_raster import SVG_RASTER_WORKERS, get_svg_image
 
 Image.MAX_IMAGE_PIXELS = None
 
+WORK_FILE_EXT = ".npy"
+# Pngs that are not deliverables are written for speed, not size.
+FAST_PNG_COMPRESSION = 1
+# Encode deliverable pngs in parallel row strips rather than with PIL's single thread.
+USE_PARALLEL_PNG_ENCODER = True
+
+
+# How an image file is used decides its format.
+class ImageFileRole(Enum):
+    # Restored files - fully compressed png or jpg with metadata.
+    DELIVERABLE = auto()
+    # Intermediate files only read back by later stages - raw '.npy' arrays that are
+    # memory mapped when read, so only the rows a stage touches are paged in.
+    WORK = auto()
+    # Intermediate files read by external tools (vtracer, gmic cli) or by people
+    # looking at debug output - lightly compressed png.
+    EXTERNAL = auto()
+
+
+def get_image_file_ext(role: ImageFileRole) -> str:
+    return WORK_FILE_EXT if role == ImageFileRole.WORK else PNG_FILE_EXT
+
+
+def svg_file_to_png(
+    svg_file: str,
+    png_file: str,
+    role: ImageFileRole = ImageFileRole.DELIVERABLE,
+    num_workers: int = SVG_RASTER_WORKERS,
+):
+    rgba_image = get_svg_image(svg_file, num_workers)
+
+    if role == ImageFileRole.DELIVERABLE and USE_PARALLEL_PNG_ENCODER:
+        write_png(png_file, rgba_image, compress_level=SAVE_PNG_COMPRESSION)
+    elif role == ImageFileRole.DELIVERABLE:
+        Image.fromarray(rgba_image).save(
+            png_file, optimize=True, compress_level=SAVE_PNG_COMPRESSION
+        )
+    else:
+        Image.fromarray(rgba_image).save(png_file, compress_level=FAST_PNG_COMPRESSION)
+
+
+def write_cv_image_file(
+    file: str,
+    image: cv.typing.MatLike,
+    metadata: Dict[str, str] = None,
+    role: ImageFileRole = ImageFileRole.DELIVERABLE,
+):
+    if os.path.splitext(file)[1] == WORK_FILE_EXT:
+        if isinstance(image, np.memmap) and image.filename == os.path.abspath(file):
+            image.flush()  # already streamed to the file - see 'get_work_image_buffer'
+        else:
+            np.save(file, np.ascontiguousarray(image))
+        return
 
-def svg_file_to_png(svg_file: str, png_file: str):
-    # background_color = "white"
-    background_color = None
-    png_image = cairosvg.svg2png(url=svg_file, scale=1, background_color=background_color)
-
-    pil_image = Image.open(BytesIO(png_image))
-    pil_image.save(png_file, optimize=True, compress_level=SAVE_PNG_COMPRESSION)
-
-
-def write_cv_image_file(file: str, image: cv.typing.MatLike, metadata: Dict[str, str] = None):
     if os.path.splitext(file)[1] == JPG_FILE_EXT:
         _write_cv_jpeg_file(file, image, metadata)
         return
 
-    if os.path.splitext(file)[1] == PNG_FILE_EXT:
+    if os.path.splitext(file)[1] == PNG_FILE_EXT and role == ImageFileRole.DELIVERABLE:
         _write_cv_png_file(file, image, metadata)
         return
 
+    if os.path.splitext(file)[1] == PNG_FILE_EXT:
+        cv.imwrite(file, image, [cv.IMWRITE_PNG_COMPRESSION, FAST_PNG_COMPRESSION])
+        return
+
     cv.imwrite(file, image)
 
 
-def resize_image_file(in_file: str, srce_scale: int, resized_file: str, metadata: Dict[str, str]):
-    if os.path.splitext(resized_file)[1] == JPG_FILE_EXT:
-        _resize_jpeg_file(in_file, srce_scale, resized_file, metadata)
-        return
+# Create a '.npy' work file and return it memory mapped for writing, so a stage can write
+# its output strip by strip straight through to the file rather than hold the whole output
+# page in memory. Writing the returned image with 'write_cv_image_file' just flushes it.
+def get_work_image_buffer(file: str, shape: Tuple[int, ...], dtype: np.dtype) -> np.memmap:
+    assert os.path.splitext(file)[1] == WORK_FILE_EXT
+    return np.lib.format.open_memmap(file, mode="w+", dtype=dtype, shape=shape)
 
-    if os.path.splitext(resized_file)[1] == PNG_FILE_EXT:
-        _resize_png_file(in_file, srce_scale, resized_file, metadata)
-        return
 
-    assert False
+# Read an image file with 'cv.imread' flags. A '.npy' work file is memory mapped and, for
+# 'cv.IMREAD_UNCHANGED', returned without a copy.
+def read_cv_image_file(file: str, flags: int = cv.IMREAD_COLOR) -> cv.typing.MatLike:
+    if os.path.splitext(file)[1] != WORK_FILE_EXT:
+        image = cv.imread(file, flags)
+        if image is None:
+            raise Exception(f'Could not read image file "{file}".')
+        return image
 
+    image = np.load(file, mmap_mode="r")
+    num_channels = 1 if image.ndim == 2 else image.shape[2]
 
-def _resize_jpeg_file(in_file: str, srce_scale: int, resized_file: str, metadata: Dict[str, str]):
-    image = cv.imread(in_file)
-    scale = 1.0 / srce_scale
-    image = cv.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv.INTER_AREA)
-    write_cv_image_file(resized_file, image, metadata)
+    if flags == cv.IMREAD_COLOR and num_channels == 1:
+        return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+    if flags == cv.IMREAD_COLOR and num_channels == 4:
+        return cv.cvtColor(image, cv.COLOR_BGRA2BGR)
+    if flags == cv.IMREAD_GRAYSCALE and num_channels == 3:
+        return cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    if flags == cv.IMREAD_GRAYSCALE and num_channels == 4:
+        return cv.cvtColor(image, cv.COLOR_BGRA2GRAY)
+
+    return image
 
 
-def _resize_png_file(in_file: str, srce_scale: int, resized_file: str, metadata: Dict[str, str]):
-    assert srce_scale in [2, 4]
-    scale_percent = 25 if srce_scale == 4 else 50
+def resize_image_file(in_file: str, srce_scale: int, resized_file: str, metadata: Dict[str, str]):
+    write_resized_image_file(read_cv_image_file(in_file), srce_scale, resized_file, metadata)
+
 
-    resize_cmd = [
-        in_file,
-        "+resize[-1]",
-        f"{scale_percent}%,{scale_percent}%,1,3,2",
-        "output[-1]",
-        resized_file,
-    ]
+# Downscale an in memory image by the integer 'srce_scale' and write it, with its metadata,
+# in a single encode.
+def write_resized_image_file(
+    image: cv.typing.MatLike, srce_scale: int, resized_file: str, metadata: Dict[str, str]
+):
+    assert os.path.splitext(resized_file)[1] in [JPG_FILE_EXT, PNG_FILE_EXT]
 
-    run_gmic(resize_cmd)
+    write_cv_image_file(resized_file, get_resized_image(image, srce_scale), metadata)
 
-    add_png_metadata(resized_file, metadata)
+
+def get_resized_image(image: cv.typing.MatLike, srce_scale: int) -> cv.typing.MatLike:
+    assert isinstance(srce_scale, int) and srce_scale >= 1
+    if srce_scale == 1:
+        return image
+
+    scale = 1.0 / srce_scale
+    return cv.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv.INTER_AREA)
 
 
 def _write_cv_png_file(file: str, image: cv.typing.MatLike, metadata: Dict[str, str]):
+    if USE_PARALLEL_PNG_ENCODER:
+        _write_cv_png_file_parallel(file, image, metadata)
+        return
+
     color_converted = cv.cvtColor(image, cv.COLOR_BGR2RGB)
     pil_image = Image.fromarray(color_converted)
 
@@ -89,6 +159,18 @@ def _write_cv_png_file(file: str, image: cv.typing.MatLike, metadata: Dict[str,
     pil_image.save(file, pnginfo=png_metadata, optimize=True, compress_level=SAVE_PNG_COMPRESSION)
 
 
+# Any alpha channel is dropped, the same as the PIL path.
+def _write_cv_png_file_parallel(file: str, image: cv.typing.MatLike, metadata: Dict[str, str]):
+    color_converted = image if image.ndim == 2 else cv.cvtColor(image, cv.COLOR_BGR2RGB)
+
+    text = dict()
+    if metadata:
+        for key in metadata:
+            text[f"{METADATA_PROPERTY_GROUP}:{key}"] = metadata[key]
+
+    write_png(file, color_converted, text, SAVE_PNG_COMPRESSION)
+
+
 def _write_cv_jpeg_file(file: str, image: cv.typing.MatLike, metadata: Dict[str, str]):
     comments_str = "" if metadata is None else "\n" + "\n".join(_get_metadata_as_list(metadata))
     color_converted = cv.cvtColor(image, cv.COLOR_BGR2RGB)
@@ -0,0 +1,205 @@
+import re
+from typing import Dict, List, Tuple
+
+import cairocffi as cairo
+import numpy as np
+
+# Rasterize traced ink outlines straight into an 8 bit alpha mask with cairo (the same
+# rasterizer cairosvg uses), rather than writing an svg, parsing it back with cairosvg
+# and decoding its png. Only the alpha is kept - the ink is black.
+
+SVG_TAG_REGEX = re.compile(r"<svg\b([^>]*)>")
+SVG_ELEMENT_TAG_REGEX = re.compile(r"<(/?)(g|path)\b([^>]*)>")
+SVG_CLIP_PATH_TAG_REGEX = re.compile(r"<clipPath\b")
+SVG_RECT_CLIP_PATH_REGEX = re.compile(r"<clipPath\b([^>]*)>\s*<rect\b([^>]*)>\s*</clipPath>")
+SVG_URL_REGEX = re.compile(r"url\(\s*#([^)\s]+)\s*\)")
+SVG_ATTRIBUTE_REGEX = re.compile(r'([\w:-]+)="([^"]*)"')
+SVG_TRANSLATE_REGEX = re.compile(r"translate\(\s*([^\s,)]+)[\s,]*([^\s,)]*)\s*\)")
+SVG_PATH_TOKEN_REGEX = re.compile(r"[MLCZmlcz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+# Number of coordinates each path command takes.
+SVG_PATH_COMMAND_ARGS = {"M": 2, "L": 2, "C": 6, "Z": 0}
+
+
+def get_ink_mask_from_potrace_curves(curves: List, width: int, height: int) -> np.ndarray:
+    surface = cairo.ImageSurface(cairo.FORMAT_A8, width, height)
+    context = cairo.Context(surface)
+    context.set_fill_rule(cairo.FILL_RULE_EVEN_ODD)
+
+    for curve in curves:
+        context.move_to(curve.start_point.x, curve.start_point.y)
+        for segment in curve.segments:
+            if segment.is_corner:
+                context.line_to(segment.c.x, segment.c.y)
+                context.line_to(segment.end_point.x, segment.end_point.y)
+            else:
+                context.curve_to(
+                    segment.c1.x,
+                    segment.c1.y,
+                    segment.c2.x,
+                    segment.c2.y,
+                    segment.end_point.x,
+                    segment.end_point.y,
+                )
+        context.close_path()
+
+    context.fill()
+
+    return _get_surface_mask(surface)
+
+
+def get_ink_mask_from_svg_file(svg_file: str) -> np.ndarray:
+    with open(svg_file, "r") as f:
+        return get_ink_mask_from_svg(f.read())
+
+
+# Only handles the svgs vtracer, potrace and tiled tracing write - a sized 'svg' element
+# holding 'path' elements with absolute or relative M, L, C and Z commands, possibly in
+# groups. Paths and groups can have a 'translate' transform, and groups can be clipped to a
+# 'clipPath' holding a single 'rect'.
+def get_ink_mask_from_svg(svg: str) -> np.ndarray:
+    clip_rects = _get_clip_rects(svg)
+
+    svg_tag = SVG_TAG_REGEX.search(svg)
+    if not svg_tag:
+        raise Exception("Could not find the svg element.")
+    svg_attributes = _get_attributes(svg_tag.group(1))
+    if "width" not in svg_attributes or "height" not in svg_attributes:
+        raise Exception("The svg element has no width and height.")
+
+    width = int(round(float(svg_attributes["width"])))
+    height = int(round(float(svg_attributes["height"])))
+
+    surface = cairo.ImageSurface(cairo.FORMAT_A8, width, height)
+    context = cairo.Context(surface)
+
+    for element_tag in SVG_ELEMENT_TAG_REGEX.finditer(svg):
+        is_end_tag, element, tag_contents = element_tag.groups()
+        if is_end_tag:
+            if element == "g":
+                context.restore()
+            continue
+
+        if element == "g":
+            context.save()
+            group_attributes = _get_attributes(tag_contents)
+            _apply_transform(context, group_attributes)
+            if "clip-path" in group_attributes:
+                _clip_to_rect(context, group_attributes["clip-path"], clip_rects)
+            if tag_contents.endswith("/"):
+                context.restore()  # an empty group
+            continue
+
+        path_attributes = _get_attributes(tag_contents)
+        if path_attributes.get("fill") == "none":
+            continue
+
+        context.save()
+
+        _apply_transform(context, path_attributes)
+
+        if path_attributes.get("fill-rule") == "evenodd":
+            context.set_fill_rule(cairo.FILL_RULE_EVEN_ODD)
+        else:
+            context.set_fill_rule(cairo.FILL_RULE_WINDING)
+
+        _add_svg_path(context, path_attributes.get("d", ""))
+        context.fill()
+
+        context.restore()
+
+    return _get_surface_mask(surface)
+
+
+def get_black_ink_image(ink_mask: np.ndarray) -> np.ndarray:
+    black_ink_image = np.zeros((ink_mask.shape[0], ink_mask.shape[1], 4), dtype=np.uint8)
+    black_ink_image[:, :, 3] = ink_mask
+
+    return black_ink_image
+
+
+def _get_attributes(tag_contents: str) -> Dict[str, str]:
+    return {name: value for name, value in SVG_ATTRIBUTE_REGEX.findall(tag_contents)}
+
+
+# The (x, y, width, height) of each 'clipPath', by id.
+def _get_clip_rects(svg: str) -> Dict[str, Tuple[float, float, float, float]]:
+    clip_rects = dict()
+    for clip_path in SVG_RECT_CLIP_PATH_REGEX.finditer(svg):
+        clip_path_id = _get_attributes(clip_path.group(1)).get("id")
+        rect_attributes = _get_attributes(clip_path.group(2))
+        clip_rects[clip_path_id] = tuple(
+            float(rect_attributes.get(name, 0)) for name in ["x", "y", "width", "height"]
+        )
+
+    if len(clip_rects) != len(SVG_CLIP_PATH_TAG_REGEX.findall(svg)):
+        raise Exception("Only clip paths of a single rect are supported.")
+
+    return clip_rects
+
+
+def _apply_transform(context: cairo.Context, attributes: Dict[str, str]):
+    if "transform" not in attributes:
+        return
+
+    translate = SVG_TRANSLATE_REGEX.fullmatch(attributes["transform"].strip())
+    if not translate:
+        raise Exception(f'Unsupported transform "{attributes["transform"]}".')
+    context.translate(float(translate.group(1)), float(translate.group(2) or 0))
+
+
+def _clip_to_rect(
+    context: cairo.Context, clip_path: str, clip_rects: Dict[str, Tuple[float, float, float, float]]
+):
+    clip_path_url = SVG_URL_REGEX.fullmatch(clip_path.strip())
+    if not clip_path_url or clip_path_url.group(1) not in clip_rects:
+        raise Exception(f'Unknown clip path "{clip_path}".')
+
+    context.rectangle(*clip_rects[clip_path_url.group(1)])
+    context.clip()
+
+
+def _add_svg_path(context: cairo.Context, path_data: str):
+    tokens = SVG_PATH_TOKEN_REGEX.findall(path_data)
+
+    command = ""
+    i = 0
+    while i < len(tokens):
+        if tokens[i].isalpha():
+            command = tokens[i]
+            i += 1
+        elif not command or command in "Zz":
+            raise Exception(f'Unexpected path coordinate "{tokens[i]}".')
+
+        num_args = SVG_PATH_COMMAND_ARGS[command.upper()]
+        if i + num_args > len(tokens):
+            raise Exception(f'Path command "{command}" is missing coordinates.')
+        args = [float(token) for token in tokens[i : i + num_args]]
+        i += num_args
+
+        if command == "M" or (command == "m" and not context.has_current_point()):
+            context.move_to(*args)
+            command = "L" if command == "M" else "l"  # further coordinate pairs are line tos
+        elif command == "m":
+            context.rel_move_to(*args)
+            command = "l"
+        elif command == "L":
+            context.line_to(*args)
+        elif command == "l":
+            context.rel_line_to(*args)
+        elif command == "C":
+            context.curve_to(*args)
+        elif command == "c":
+            context.rel_curve_to(*args)
+        else:
+            context.close_path()
+
+
+def _get_surface_mask(surface: cairo.ImageSurface) -> np.ndarray:
+    surface.flush()
+
+    width = surface.get_width()
+    height = surface.get_height()
+    data = np.frombuffer(surface.get_data(), dtype=np.uint8)
+
+    return data.reshape(height, surface.get_stride())[:, :width].copy()
@@ -1,10 +1,43 @@
+import concurrent.futures
 import os.path
+from enum import Enum, auto
+from typing import Iterator, Tuple
 
 import cv2 as cv
 import numpy as np
 
-from .gmic_exe import run_gmic
-from .image_io import write_cv_image_file
+from .background_writer import get_background_writer
+from .gmic_exe import run_gmic_on_images
+from .image_io import ImageFileRole, write_cv_image_file
+from .tiling import apply_in_strips
+
+
+class InpaintMethod(Enum):
+    # gmic patch matching over the whole page.
+    GMIC_MATCHPATCH = auto()
+    # opencv inpainting of padded crops around the ink only, in parallel threads.
+    ROI_TELEA = auto()
+    # Fill each ink pixel with the color of the nearest flat colored region.
+    FLAT_COLOR_FILL = auto()
+
+
+# The other methods fill differently from gmic (telea is blurrier on thick ink), so they
+# are opt in until their output has been compared on real pages.
+INPAINT_METHOD = InpaintMethod.GMIC_MATCHPATCH
+
+INPAINT_RADIUS = 5
+# Each connected component of the ink is inpainted in a crop of its bounding box with this
+# much padding around it, which gives the inpainting the surrounding colors to work from.
+# Components bigger than a tile (the panel borders join up most of a page's ink) are done
+# a tile at a time.
+INPAINT_ROI_TILE_SIZE = 512
+INPAINT_ROI_PADDING = 16
+# Threads for one page. Divide the cores by the number of pages inpainted at once.
+INPAINT_THREADS = os.cpu_count()
+
+# A region's color is taken from pixels at least this far from the ink, away from any
+# jpeg ringing and antialiasing next to the ink lines.
+FLAT_FILL_EDGE_MARGIN = 2
 
 
 def inpaint_image_file(
@@ -20,35 +53,209 @@ def inpaint_image_file(
         raise Exception(f'File not found: "{black_ink_mask_file}".')
 
     input_image = cv.imread(in_file)
-    assert input_image.shape[2] == 3
     black_ink_mask = cv.imread(black_ink_mask_file, cv.COLOR_BGR2GRAY)
-    assert black_ink_mask.shape[2] == 3
 
-    _, remove_mask = cv.threshold(black_ink_mask, 100, 255, cv.THRESH_BINARY_INV)
-    assert remove_mask.shape[2] == 3
+    out_image = inpaint_image(work_dir, work_file_stem, input_image, black_ink_mask, True)
+
+    write_cv_image_file(out_file, out_image)
+    get_background_writer().wait()
+
+
+# The debug files are written in the background - see 'BackgroundWriter'.
+def inpaint_image(
+    work_dir: str,
+    work_file_stem: str,
+    input_image: cv.typing.MatLike,
+    black_ink_mask: cv.typing.MatLike,
+    write_debug_files: bool,
+    inpaint_method: InpaintMethod = INPAINT_METHOD,
+    num_threads: int = INPAINT_THREADS,
+) -> cv.typing.MatLike:
+    assert input_image.shape[2] == 3
+    assert black_ink_mask.shape[2] in [3, 4]
+
+    remove_mask = np.empty(black_ink_mask.shape[:2], dtype=np.uint8)
+    apply_in_strips(_get_remove_mask, [black_ink_mask], remove_mask)
 
-    _, _, r_remove_mask = cv.split(remove_mask)
+    if write_debug_files:
+        remove_mask_file = os.path.join(work_dir, f"{work_file_stem}-remove-mask.png")
+        get_background_writer().submit(
+            remove_mask.nbytes,
+            write_cv_image_file,
+            remove_mask_file,
+            remove_mask,
+            role=ImageFileRole.EXTERNAL,
+        )
 
-    remove_mask = np.uint8(r_remove_mask)
-    # logging.info(remove_mask.shape)
-    remove_mask_file = os.path.join(work_dir, f"{work_file_stem}-remove-mask.png")
-    write_cv_image_file(remove_mask_file, remove_mask)
+    if inpaint_method == InpaintMethod.ROI_TELEA:
+        return _get_roi_inpainted_image(input_image, remove_mask, num_threads)
+    if inpaint_method == InpaintMethod.FLAT_COLOR_FILL:
+        return _get_flat_color_filled_image(input_image, remove_mask)
 
     # gmic blend/remove - pipeline??
-    b, g, r = cv.split(input_image)
-    b = np.where(remove_mask == 255, 0, b)
-    g = np.where(remove_mask == 255, 0, g)
-    r = np.where(remove_mask == 255, 255, r)
-    out_image = cv.merge([b, g, r])
-    in_file_black_removed = os.path.join(work_dir, f"{work_file_stem}-input-black-removed.png")
-    write_cv_image_file(in_file_black_removed, out_image)
+    out_image = np.empty_like(input_image)
+    apply_in_strips(_get_black_removed_image, [input_image, remove_mask], out_image)
+    if write_debug_files:
+        in_file_black_removed = os.path.join(work_dir, f"{work_file_stem}-input-black-removed.png")
+        get_background_writer().submit(
+            out_image.nbytes,
+            write_cv_image_file,
+            in_file_black_removed,
+            out_image,
+            role=ImageFileRole.EXTERNAL,
+        )
 
     inpaint_cmd = [
-        in_file_black_removed,
         "-fx_inpaint_matchpatch",
         '"1","5","26","5","1","255","0","0","255","1","0"',
-        "output",
-        out_file,
     ]
 
-    run_gmic(inpaint_cmd)
+    return run_gmic_on_images(inpaint_cmd, [out_image])
+
+
+def _get_remove_mask(black_ink_mask: cv.typing.MatLike) -> cv.typing.MatLike:
+    # Only the red channel is used so any alpha channel is ignored.
+    r_black_ink_mask = np.ascontiguousarray(black_ink_mask[:, :, 2])
+    _, remove_mask = cv.threshold(r_black_ink_mask, 100, 255, cv.THRESH_BINARY_INV)
+
+    return np.uint8(remove_mask)
+
+
+def _get_black_removed_image(
+    input_image: cv.typing.MatLike, remove_mask: cv.typing.MatLike
+) -> cv.typing.MatLike:
+    b, g, r = cv.split(input_image)
+    b = np.where(remove_mask == 255, 0, b)
+    g = np.where(remove_mask == 255, 0, g)
+    r = np.where(remove_mask == 255, 255, r)
+    return cv.merge([b, g, r])
+
+
+# Only the remove mask's pixels change, so the work is done on crops around the ink rather
+# than the whole page. Each crop writes back only its own component's pixels in its roi,
+# so the crops write separate sets of pixels even where their rois overlap.
+def _get_roi_inpainted_image(
+    input_image: cv.typing.MatLike, remove_mask: cv.typing.MatLike, num_threads: int
+) -> cv.typing.MatLike:
+    out_image = np.array(input_image)
+
+    num_labels, labels, stats, _ = cv.connectedComponentsWithStats(remove_mask, connectivity=8)
+
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        futures = [
+            executor.submit(_inpaint_roi, input_image, remove_mask, labels, out_image, roi)
+            for roi in _get_inpaint_rois(num_labels, labels, stats)
+        ]
+        for future in futures:
+            future.result()
+
+    return out_image
+
+
+# A roi is (x, y, w, h, label) - the bounding box of the component's pixels in it.
+def _get_inpaint_rois(
+    num_labels: int, labels: cv.typing.MatLike, stats: np.ndarray
+) -> Iterator[Tuple[int, int, int, int, int]]:
+    for label in range(1, num_labels):  # label 0 is the background
+        x, y, w, h, _ = stats[label]
+        if w <= INPAINT_ROI_TILE_SIZE and h <= INPAINT_ROI_TILE_SIZE:
+            yield x, y, w, h, label
+            continue
+
+        for tile_y in range(y, y + h, INPAINT_ROI_TILE_SIZE):
+            for tile_x in range(x, x + w, INPAINT_ROI_TILE_SIZE):
+                tile_y1 = min(tile_y + INPAINT_ROI_TILE_SIZE, y + h)
+                tile_x1 = min(tile_x + INPAINT_ROI_TILE_SIZE, x + w)
+                tile_mask = np.uint8(labels[tile_y:tile_y1, tile_x:tile_x1] == label)
+                if not tile_mask.any():
+                    continue
+
+                roi_x, roi_y, roi_w, roi_h = cv.boundingRect(tile_mask)
+                yield tile_x + roi_x, tile_y + roi_y, roi_w, roi_h, label
+
+
+def _inpaint_roi(
+    input_image: cv.typing.MatLike,
+    remove_mask: cv.typing.MatLike,
+    labels: cv.typing.MatLike,
+    out_image: cv.typing.MatLike,
+    roi: Tuple[int, int, int, int, int],
+):
+    x, y, w, h, label = roi
+    height, width = remove_mask.shape
+    x0 = max(0, x - INPAINT_ROI_PADDING)
+    y0 = max(0, y - INPAINT_ROI_PADDING)
+    x1 = min(width, x + w + INPAINT_ROI_PADDING)
+    y1 = min(height, y + h + INPAINT_ROI_PADDING)
+
+    # All the mask pixels in the crop are inpainted, including those of neighboring rois,
+    # so no ink is used as a source. Only this roi's pixels are written back.
+    inpainted = cv.inpaint(
+        np.ascontiguousarray(input_image[y0:y1, x0:x1]),
+        np.ascontiguousarray(remove_mask[y0:y1, x0:x1]),
+        INPAINT_RADIUS,
+        cv.INPAINT_TELEA,
+    )
+
+    roi_mask = labels[y : y + h, x : x + w] == label
+    roi_inpainted = inpainted[y - y0 : y - y0 + h, x - x0 : x - x0 + w]
+    out_image[y : y + h, x : x + w][roi_mask] = roi_inpainted[roi_mask]
+
+
+# Barks pages are flat colored regions bounded by ink. The non-ink pixels are labeled into
+# regions, each region gets the median color of its interior and each ink pixel takes the
+# color of the region its nearest non-ink pixel is in. Everything is a vectorized pass
+# over the pixels.
+def _get_flat_color_filled_image(
+    input_image: cv.typing.MatLike, remove_mask: cv.typing.MatLike
+) -> cv.typing.MatLike:
+    out_image = np.array(input_image)
+
+    is_ink = remove_mask != 0
+    if is_ink.all() or not is_ink.any():
+        return out_image
+
+    non_ink = np.uint8(~is_ink)
+    num_regions, region_labels = cv.connectedComponents(non_ink, connectivity=4)
+    region_colors = _get_region_colors(input_image, non_ink, region_labels, num_regions)
+
+    # The nearest non-ink pixel labels are the non-ink pixels numbered in raster order.
+    _, nearest_labels = cv.distanceTransformWithLabels(
+        remove_mask, cv.DIST_L2, cv.DIST_MASK_5, labelType=cv.DIST_LABEL_PIXEL
+    )
+    non_ink_regions = region_labels[~is_ink]
+    ink_regions = non_ink_regions[nearest_labels[is_ink] - 1]
+
+    out_image[is_ink] = region_colors[ink_regions]
+
+    return out_image
+
+
+def _get_region_colors(
+    image: cv.typing.MatLike,
+    non_ink: cv.typing.MatLike,
+    region_labels: cv.typing.MatLike,
+    num_regions: int,
+) -> np.ndarray:
+    interior = cv.erode(non_ink, np.ones((3, 3), np.uint8), iterations=FLAT_FILL_EDGE_MARGIN) != 0
+
+    # Regions too thin to have an interior use all their pixels.
+    interior_counts = np.bincount(region_labels[interior], minlength=num_regions)
+    use_pixel = interior | ((non_ink != 0) & (interior_counts[region_labels] == 0))
+
+    # A median rather than a mean, so a region with two flat colors meeting without an ink
+    # line, jpeg noise or stray ink gets its main color, not a mix that's nowhere on the
+    # page. Each channel's (label, value) pairs are sorted as one key, so every region's
+    # values are in order in its own run of the sorted keys.
+    key_dtype = np.uint32 if num_regions <= 2**24 else np.uint64
+    used_labels = region_labels[use_pixel].astype(key_dtype)
+    counts = np.bincount(used_labels, minlength=num_regions)
+    median_indexes = np.cumsum(counts) - counts + np.maximum(counts - 1, 0) // 2
+
+    region_colors = np.zeros((num_regions, 3), dtype=np.uint8)
+    has_pixels = counts > 0
+    for channel in range(3):
+        keys = np.sort(used_labels * 256 + image[:, :, channel][use_pixel])
+        region_colors[has_pixels, channel] = keys[median_indexes[has_pixels]] % 256
+
+    return region_colors
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Tuple
+
+import psutil
+
+# Keep this fraction of the memory that was available at the start free.
+SAFETY_MARGIN = 0.15
+# Number of recent measurements kept per stage, and the percentile of them used, so the
+# estimates follow changes rather than only ever growing.
+NUM_STAGE_SAMPLES = 20
+SAMPLE_PERCENTILE = 90
+# The memory a worker process already holds when it starts a task (the interpreter, numba,
+# cv2 and anything left from earlier pages), used until it has been measured.
+DEFAULT_PROCESS_OVERHEAD_MB = 500.0
+RSS_SAMPLE_INTERVAL_SECS = 0.2
+
+# Stats files of other versions are ignored. Version 1 kept absolute peaks per megapixel.
+MEMORY_STATS_VERSION = 2
+
+BYTES_PER_MB = 1024 * 1024
+
+
+# Samples the resident memory of this process and its child processes (for example gmic
+# or upscayl) in a background thread and keeps the peak, and the memory at the start so the
+# growth in the 'with' block is known too.
+class PeakRssSampler:
+    def __init__(self, interval_secs: float = RSS_SAMPLE_INTERVAL_SECS):
+        self.interval_secs = interval_secs
+        self.start_rss = 0
+        self.peak_rss = 0
+        self._process = psutil.Process()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self) -> "PeakRssSampler":
+        self._update_peak()
+        self.start_rss = self.peak_rss
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop_event.set()
+        self._thread.join()
+        self._update_peak()
+
+    @property
+    def peak_rss_growth(self) -> int:
+        return max(0, self.peak_rss - self.start_rss)
+
+    def _sample(self):
+        while not self._stop_event.wait(self.interval_secs):
+            self._update_peak()
+
+    def _update_peak(self):
+        rss = self._process.memory_info().rss
+        for child in self._process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass  # child has finished
+
+        self.peak_rss = max(self.peak_rss, rss)
+
+
+# Admits stage work only while the memory all running work is projected to need still fits
+# in the available memory. The projection for a task is a worker process's own memory plus
+# the stage's peak memory growth per megapixel times the page size. Both are measured on
+# earlier tasks and saved in 'stats_file' across runs.
+class MemoryAdmission:
+    def __init__(
+        self,
+        stats_file: str,
+        default_mb_per_mpixel: Dict[str, float],
+        safety_margin: float = SAFETY_MARGIN,
+        default_process_overhead_mb: float = DEFAULT_PROCESS_OVERHEAD_MB,
+    ):
+        self.stats_file = stats_file
+        self.default_mb_per_mpixel = default_mb_per_mpixel
+        self.default_process_overhead_mb = default_process_overhead_mb
+        self.memory_budget = int(psutil.virtual_memory().available * (1.0 - safety_margin))
+        self.safety_margin = safety_margin
+        self.reserved = 0
+        self._reservations: Dict[Any, Tuple[str, float, int]] = dict()
+
+        self._stage_samples: Dict[str, List[float]] = dict()
+        self._process_overhead_samples: List[float] = []
+        if os.path.isfile(stats_file):
+            with open(stats_file, "r") as f:
+                stats = json.load(f)
+            if stats.get("version") == MEMORY_STATS_VERSION:
+                self._stage_samples = stats["mb_per_mpixel"]
+                self._process_overhead_samples = stats["process_overhead_mb"]
+
+        logging.info(f"Memory admission budget: {self.memory_budget // BYTES_PER_MB} MB.")
+
+    def get_mb_per_mpixel(self, stage: str) -> float:
+        samples = self._stage_samples.get(stage)
+        if samples:
+            return _get_percentile(samples, SAMPLE_PERCENTILE)
+
+        return self.default_mb_per_mpixel[stage]
+
+    def get_process_overhead_mb(self) -> float:
+        if self._process_overhead_samples:
+            return _get_percentile(self._process_overhead_samples, SAMPLE_PERCENTILE)
+
+        return self.default_process_overhead_mb
+
+    def get_estimated_bytes(self, stage: str, megapixels: float) -> int:
+        estimated_mb = self.get_process_overhead_mb() + self.get_mb_per_mpixel(stage) * megapixels
+        return int(estimated_mb * BYTES_PER_MB)
+
+    # Reserve memory for the stage task if it fits. 'force' admits it regardless, so that
+    # there is always at least one task running.
+    def try_admit(self, task: Any, stage: str, megapixels: float, force: bool = False) -> bool:
+        estimate = self.get_estimated_bytes(stage, megapixels)
+
+        if not force:
+            if self.reserved + estimate > self.memory_budget:
+                return False
+            if estimate > psutil.virtual_memory().available * (1.0 - self.safety_margin):
+                return False
+
+        self.reserved += estimate
+        self._reservations[task] = (stage, megapixels, estimate)
+        return True
+
+    # Free the task's reservation and learn from its worker's memory at the start of the task
+    # and its peak growth during it - see 'PeakRssSampler' (0 if not measured).
+    def release(self, task: Any, start_rss: int, peak_rss_growth: int):
+        stage, megapixels, estimate = self._reservations.pop(task)
+        self.reserved -= estimate
+
+        if start_rss <= 0 or megapixels <= 0:
+            return
+
+        self._process_overhead_samples.append(start_rss / BYTES_PER_MB)
+        del self._process_overhead_samples[:-NUM_STAGE_SAMPLES]
+
+        samples = self._stage_samples.setdefault(stage, [])
+        samples.append(peak_rss_growth / BYTES_PER_MB / megapixels)
+        del samples[:-NUM_STAGE_SAMPLES]
+
+        self._save()
+
+    def _save(self):
+        stats = {
+            "version": MEMORY_STATS_VERSION,
+            "mb_per_mpixel": self._stage_samples,
+            "process_overhead_mb": self._process_overhead_samples,
+        }
+        temp_file = self.stats_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(stats, f, indent=4)
+        os.replace(temp_file, self.stats_file)
+
+
+# The sample at or just above the given percentile.
+def _get_percentile(samples: List[float], percentile: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
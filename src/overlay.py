@@ -1,6 +1,15 @@
 import os.path
 
-from .gmic_exe import run_gmic
+import cv2 as cv
+import numpy as np
+
+from .gmic_exe import run_gmic, run_gmic_on_images
+from .image_io import read_cv_image_file, write_cv_image_file
+from .ink_mask import get_black_ink_image
+from .tiling import apply_in_strips
+
+# Composite the ink with numpy, in strips, rather than with gmic. The output is the same.
+USE_NUMPY_OVERLAY = True
 
 
 def overlay_inpainted_file_with_black_ink(
@@ -13,6 +22,14 @@ def overlay_inpainted_file_with_black_ink(
     if not os.path.exists(black_ink_file):
         raise Exception(f'File not found: "{black_ink_file}".')
 
+    if USE_NUMPY_OVERLAY:
+        out_image = overlay_inpainted_image_with_black_ink(
+            read_cv_image_file(inpaint_file),
+            read_cv_image_file(black_ink_file, cv.IMREAD_UNCHANGED),
+        )
+        write_cv_image_file(out_file, out_image)
+        return
+
     overlay_cmd = [
         inpaint_file,
         black_ink_file,
@@ -25,3 +42,44 @@ def overlay_inpainted_file_with_black_ink(
     ]
 
     run_gmic(overlay_cmd)
+
+
+def overlay_inpainted_image_with_black_ink(
+    inpaint_image: cv.typing.MatLike, black_ink_image: cv.typing.MatLike
+) -> cv.typing.MatLike:
+    # Either a black ink alpha mask or a BGRA ink image.
+    assert black_ink_image.ndim == 2 or black_ink_image.shape[2] == 4
+
+    if USE_NUMPY_OVERLAY:
+        out_image = np.empty_like(inpaint_image)
+        apply_in_strips(_get_overlay_image, [inpaint_image, black_ink_image], out_image)
+        return out_image
+
+    if black_ink_image.ndim == 2:
+        black_ink_image = get_black_ink_image(black_ink_image)
+
+    overlay_cmd = [
+        "+channels[-1]",
+        "100%",
+        "+image[0]",
+        "[1],0%,0%,0,0,1,[2],255",
+    ]
+
+    return run_gmic_on_images(overlay_cmd, [inpaint_image, black_ink_image])
+
+
+# The same float arithmetic as the gmic 'image' command with the ink alpha as the mask,
+# truncated to uint8 as gmic does.
+def _get_overlay_image(
+    inpaint_image: cv.typing.MatLike, black_ink_image: cv.typing.MatLike
+) -> cv.typing.MatLike:
+    if black_ink_image.ndim == 2:
+        alpha = black_ink_image[:, :, np.newaxis].astype(np.float32)
+        ink = 0
+    else:
+        alpha = black_ink_image[:, :, 3:4].astype(np.float32)
+        ink = black_ink_image[:, :, :3]
+
+    overlay = (alpha * ink + inpaint_image * (255 - alpha)) / 255
+
+    return overlay.astype(np.uint8)
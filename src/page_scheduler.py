@@ -0,0 +1,147 @@
+import concurrent.futures
+import logging
+import os
+from typing import Any, Callable, Dict, List, NamedTuple, Set, Tuple
+
+from .memory_admission import MemoryAdmission, PeakRssSampler
+
+
+# A class of work run for every page. 'func' is called with the page in a worker process,
+# so it must be a picklable top level function. 'max_workers' limits how many pages can
+# be in this stage at once and 'depends_on' names the stages a page must finish first.
+class PageStage(NamedTuple):
+    name: str
+    func: Callable[[Any], Any]
+    max_workers: int
+    depends_on: List[str]
+
+
+# Stream pages through a graph of stages. Unlike running each stage for all pages behind
+# a barrier, a page starts its next stage as soon as that stage's dependencies are done
+# for the page and the stage has a free worker. Later stages are preferred so pages are
+# finished (and their memory and disk freed) as soon as possible.
+#
+# 'on_stage_done' is called in this process with the page, stage name and the result of
+# the stage func. A stage that raises stops the rest of that page's stages.
+#
+# With an 'admission' a stage is only started when its projected memory, from
+# 'get_page_megapixels', fits. Each stage's measured peak memory is fed back to it.
+# The worker limits are then just upper bounds - more small pages run at once than
+# large ones.
+class PageScheduler:
+    def __init__(
+        self,
+        stages: List[PageStage],
+        max_total_workers: int = os.cpu_count(),
+        on_stage_done: Callable[[Any, str, Any], None] = None,
+        admission: MemoryAdmission = None,
+        get_page_megapixels: Callable[[Any], float] = None,
+    ):
+        self.stages = stages
+        self.max_total_workers = max_total_workers
+        self.on_stage_done = on_stage_done
+        self.admission = admission
+        self.get_page_megapixels = get_page_megapixels
+
+        if admission and not get_page_megapixels:
+            raise Exception("Memory admission needs a page megapixels function.")
+
+        stage_names = [stage.name for stage in stages]
+        for stage in stages:
+            for dependency in stage.depends_on:
+                if dependency not in stage_names:
+                    raise Exception(f'Stage "{stage.name}" has unknown dependency "{dependency}".')
+
+    def run(self, pages: List[Any]) -> List[Tuple[Any, str]]:
+        done: List[Set[str]] = [set() for _ in pages]
+        failed: Set[int] = set()
+        not_started: Set[Tuple[int, int]] = {
+            (page_index, stage_index)
+            for page_index in range(len(pages))
+            for stage_index in range(len(self.stages))
+        }
+        running: Dict[concurrent.futures.Future, Tuple[int, int]] = dict()
+        num_running_per_stage = [0] * len(self.stages)
+        failures: List[Tuple[Any, str]] = []
+        page_megapixels = (
+            [self.get_page_megapixels(page) for page in pages] if self.admission else []
+        )
+
+        with concurrent.futures.ProcessPoolExecutor(self.max_total_workers) as executor:
+            while not_started or running:
+                for page_index, stage_index in self._get_ready_tasks(not_started, done, failed):
+                    if len(running) >= self.max_total_workers:
+                        break
+                    stage = self.stages[stage_index]
+                    if num_running_per_stage[stage_index] >= stage.max_workers:
+                        continue
+                    if self.admission and not self.admission.try_admit(
+                        (page_index, stage_index),
+                        stage.name,
+                        page_megapixels[page_index],
+                        force=not running,
+                    ):
+                        # Wait for memory rather than let smaller tasks starve this one.
+                        break
+
+                    not_started.remove((page_index, stage_index))
+                    if self.admission:
+                        future = executor.submit(_run_measured, stage.func, pages[page_index])
+                    else:
+                        future = executor.submit(stage.func, pages[page_index])
+                    running[future] = (page_index, stage_index)
+                    num_running_per_stage[stage_index] += 1
+
+                if not running:
+                    # Everything left depends on a failed stage.
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    page_index, stage_index = running.pop(future)
+                    num_running_per_stage[stage_index] -= 1
+                    stage_name = self.stages[stage_index].name
+
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.error(f'Stage "{stage_name}" failed for page {page_index}: {e}')
+                        if self.admission:
+                            self.admission.release((page_index, stage_index), 0, 0)
+                        failed.add(page_index)
+                        failures.append((pages[page_index], stage_name))
+                        continue
+
+                    if self.admission:
+                        result, start_rss, peak_rss_growth = result
+                        self.admission.release(
+                            (page_index, stage_index), start_rss, peak_rss_growth
+                        )
+
+                    done[page_index].add(stage_name)
+                    if self.on_stage_done:
+                        self.on_stage_done(pages[page_index], stage_name, result)
+
+        return failures
+
+    def _get_ready_tasks(
+        self, not_started: Set[Tuple[int, int]], done: List[Set[str]], failed: Set[int]
+    ) -> List[Tuple[int, int]]:
+        ready = [
+            (page_index, stage_index)
+            for page_index, stage_index in not_started
+            if page_index not in failed
+            and all(dep in done[page_index] for dep in self.stages[stage_index].depends_on)
+        ]
+
+        # Latest stages first, then pages in order.
+        return sorted(ready, key=lambda task: (-task[1], task[0]))
+
+
+def _run_measured(func: Callable[[Any], Any], page: Any) -> Tuple[Any, int, int]:
+    with PeakRssSampler() as sampler:
+        result = func(page)
+
+    return result, sampler.start_rss, sampler.peak_rss_growth
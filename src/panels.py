@@ -0,0 +1,108 @@
+import json
+import os
+from typing import List
+
+import cv2 as cv
+import numpy as np
+
+from .tiling import Tile, get_expanded_tile, get_tiles
+
+# Find a page's panels by recursive xy cuts: split the ink at every run of empty rows, then
+# of empty columns, at least PANEL_MIN_GUTTER wide, until no block can be split further.
+# The blocks cover all the ink, so work done per panel misses nothing but the gutters.
+# Each panel is then padded by half the minimum gutter, which still keeps panels apart, so
+# anything drawn a little past the ink (like a traced curve's overshoot) isn't cut off.
+# Any pixel darker than PANEL_WHITE_LEVEL counts as ink, which is more than vtracer traces.
+PANEL_MIN_GUTTER = 16
+PANEL_WHITE_LEVEL = 240
+
+
+def get_page_ink(image: cv.typing.MatLike) -> np.ndarray:
+    if image.ndim == 3:
+        image = cv.cvtColor(image[:, :, :3], cv.COLOR_BGR2GRAY)
+
+    return image < PANEL_WHITE_LEVEL
+
+
+def get_panels(ink: np.ndarray, min_gutter: int = PANEL_MIN_GUTTER) -> List[Tile]:
+    height, width = ink.shape
+    panels = []
+
+    blocks = [Tile(0, 0, width, height)]
+    while blocks:
+        block = blocks.pop()
+        block_ink = ink[block.y0 : block.y1, block.x0 : block.x1]
+
+        row_runs = _get_ink_runs(block_ink.any(axis=1), min_gutter)
+        col_runs = _get_ink_runs(block_ink.any(axis=0), min_gutter)
+        if not row_runs:
+            continue
+
+        if len(row_runs) > 1:
+            x0 = block.x0 + col_runs[0][0]
+            x1 = block.x0 + col_runs[-1][1]
+            blocks.extend(Tile(x0, block.y0 + y0, x1, block.y0 + y1) for y0, y1 in row_runs)
+        elif len(col_runs) > 1:
+            y0 = block.y0 + row_runs[0][0]
+            y1 = block.y0 + row_runs[0][1]
+            blocks.extend(Tile(block.x0 + x0, y0, block.x0 + x1, y1) for x0, x1 in col_runs)
+        else:
+            panels.append(
+                Tile(
+                    block.x0 + col_runs[0][0],
+                    block.y0 + row_runs[0][0],
+                    block.x0 + col_runs[0][1],
+                    block.y0 + row_runs[0][1],
+                )
+            )
+
+    panels = [get_expanded_tile(panel, min_gutter // 2, width, height) for panel in panels]
+
+    return sorted(panels, key=lambda panel: (panel.y0, panel.x0))
+
+
+# Start and end (exclusive) of the runs of ink in a row or column profile, joining runs
+# separated by fewer than 'min_gap' empty entries.
+def _get_ink_runs(has_ink: np.ndarray, min_gap: int) -> List[tuple]:
+    ink_indices = np.flatnonzero(has_ink)
+    if len(ink_indices) == 0:
+        return []
+
+    gap_after = np.flatnonzero(np.diff(ink_indices) > min_gap)
+    starts = np.concatenate(([ink_indices[0]], ink_indices[gap_after + 1]))
+    ends = np.concatenate((ink_indices[gap_after] + 1, [ink_indices[-1] + 1]))
+
+    return [(int(start), int(end)) for start, end in zip(starts, ends)]
+
+
+# Panels are detected once per 'key' (for example the stage key of the image they're
+# found in) and kept in a small json file.
+def get_cached_panels(panels_file: str, key: str, image: cv.typing.MatLike) -> List[Tile]:
+    if os.path.isfile(panels_file):
+        with open(panels_file, "r") as f:
+            cached_panels = json.load(f)
+        if cached_panels["key"] == key:
+            return [Tile(*panel) for panel in cached_panels["panels"]]
+
+    panels = get_panels(get_page_ink(image))
+
+    temp_file = panels_file + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump({"key": key, "panels": [list(panel) for panel in panels]}, f, indent=4)
+    os.replace(temp_file, panels_file)
+
+    return panels
+
+
+# Split any panel bigger than 'max_tile_size' into tiles, biggest first, so a pool of
+# workers taking them in order is kept evenly loaded.
+def get_panel_work_tiles(panels: List[Tile], max_tile_size: int) -> List[Tile]:
+    work_tiles = []
+    for panel in panels:
+        panel_tiles = get_tiles(panel.x1 - panel.x0, panel.y1 - panel.y0, max_tile_size)
+        work_tiles.extend(
+            Tile(panel.x0 + t.x0, panel.y0 + t.y0, panel.x0 + t.x1, panel.y0 + t.y1)
+            for t in panel_tiles
+        )
+
+    return sorted(work_tiles, key=lambda t: (t.x1 - t.x0) * (t.y1 - t.y0), reverse=True)
@@ -0,0 +1,173 @@
+import concurrent.futures
+import os
+import struct
+import zlib
+from typing import Dict, List
+
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_STRIP_HEIGHT = 128
+PNG_ENCODE_THREADS = os.cpu_count()
+# Each strip's deflate stream is primed with the previous strip's last 32K, so
+# splitting into strips costs almost nothing in file size.
+DEFLATE_WINDOW_SIZE = 32 * 1024
+
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}  # channels -> gray, gray alpha, RGB, RGBA
+
+ADLER32_BASE = 65521
+
+
+# Encode an 8 bit gray, RGB or RGBA image (in that channel order) as a png. Row strips are
+# filtered and deflated in parallel threads (zlib and numpy release the gil) and the
+# deflate streams joined into one zlib stream, split across one IDAT chunk per strip.
+# Each row uses the png filter with the smallest sum of absolute values, as libpng does.
+def write_png(
+    file: str,
+    image: np.ndarray,
+    text: Dict[str, str] = None,
+    compress_level: int = 9,
+    num_threads: int = PNG_ENCODE_THREADS,
+):
+    assert image.dtype == np.uint8
+    height, width = image.shape[:2]
+    num_channels = 1 if image.ndim == 2 else image.shape[2]
+    rows = np.ascontiguousarray(image).reshape(height, width * num_channels)
+
+    strips = [
+        (start, min(start + PNG_STRIP_HEIGHT, height))
+        for start in range(0, height, PNG_STRIP_HEIGHT)
+    ]
+
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        filtered_strips = list(
+            executor.map(lambda strip: _get_filtered_rows(rows, num_channels, *strip), strips)
+        )
+        compressed_strips = list(
+            executor.map(
+                lambda i: _compress_strip(filtered_strips, i, compress_level),
+                range(len(strips)),
+            )
+        )
+
+    adler = 1
+    for filtered_strip in filtered_strips:
+        strip_adler = zlib.adler32(filtered_strip)
+        adler = _adler32_combine(adler, strip_adler, len(filtered_strip))
+
+    with open(file, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        ihdr = struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[num_channels], 0, 0, 0)
+        _write_chunk(f, b"IHDR", ihdr)
+
+        if text:
+            for key, value in text.items():
+                _write_text_chunk(f, key, value)
+
+        for i, compressed_strip in enumerate(compressed_strips):
+            if i == 0:
+                compressed_strip = _get_zlib_header(compress_level) + compressed_strip
+            if i == len(compressed_strips) - 1:
+                compressed_strip += struct.pack(">I", adler)
+            _write_chunk(f, b"IDAT", compressed_strip)
+
+        _write_chunk(f, b"IEND", b"")
+
+
+def _get_filtered_rows(rows: np.ndarray, bpp: int, start: int, end: int) -> bytes:
+    x = rows[start:end].astype(np.int16)
+    prior = rows[start - 1 : end - 1].astype(np.int16) if start > 0 else None
+    if prior is None:
+        prior = np.zeros_like(x)
+        prior[1:] = x[:-1]
+
+    left = np.zeros_like(x)
+    left[:, bpp:] = x[:, :-bpp]
+    upper_left = np.zeros_like(x)
+    upper_left[:, bpp:] = prior[:, :-bpp]
+
+    # Paeth predictor.
+    pa = np.abs(prior - upper_left)
+    pb = np.abs(left - upper_left)
+    pc = np.abs(left + prior - 2 * upper_left)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, prior, upper_left))
+
+    # Filter types 0 to 4: none, sub, up, average and paeth.
+    filtered = np.stack([x, x - left, x - prior, x - ((left + prior) >> 1), x - paeth])
+    filtered = filtered.astype(np.uint8)
+
+    signed_abs = np.minimum(filtered, 256 - filtered.astype(np.int16))
+    best_filters = signed_abs.sum(axis=2, dtype=np.int64).argmin(axis=0)
+
+    out = np.empty((end - start, rows.shape[1] + 1), dtype=np.uint8)
+    out[:, 0] = best_filters
+    out[:, 1:] = filtered[best_filters, np.arange(end - start)]
+
+    return out.tobytes()
+
+
+def _compress_strip(filtered_strips: List[bytes], index: int, compress_level: int) -> bytes:
+    if index == 0:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    else:
+        window = filtered_strips[index - 1][-DEFLATE_WINDOW_SIZE:]
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15, zdict=window)
+
+    is_last = index == len(filtered_strips) - 1
+    flush_mode = zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH
+
+    return compressor.compress(filtered_strips[index]) + compressor.flush(flush_mode)
+
+
+def _get_zlib_header(compress_level: int) -> bytes:
+    if compress_level < 2:
+        level_flags = 0
+    elif compress_level < 6:
+        level_flags = 1
+    elif compress_level == 6:
+        level_flags = 2
+    else:
+        level_flags = 3
+    cmf = 0x78  # deflate with a 32K window
+    flg = level_flags << 6
+    flg += 31 - ((cmf << 8) + flg) % 31
+
+    return bytes([cmf, flg])
+
+
+# The adler32 of two concatenated buffers from their separate adler32s - zlib's
+# 'adler32_combine', which python's zlib doesn't expose.
+def _adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+    rem = len2 % ADLER32_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % ADLER32_BASE
+    sum1 += (adler2 & 0xFFFF) + ADLER32_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xFFFF) + ((adler2 >> 16) & 0xFFFF) + ADLER32_BASE - rem
+
+    if sum1 >= ADLER32_BASE:
+        sum1 -= ADLER32_BASE
+    if sum1 >= ADLER32_BASE:
+        sum1 -= ADLER32_BASE
+    if sum2 >= 2 * ADLER32_BASE:
+        sum2 -= 2 * ADLER32_BASE
+    if sum2 >= ADLER32_BASE:
+        sum2 -= ADLER32_BASE
+
+    return sum1 | (sum2 << 16)
+
+
+# Latin-1 text goes in a tEXt chunk, anything else in an iTXt chunk - the same as PIL.
+def _write_text_chunk(f, key: str, value: str):
+    try:
+        _write_chunk(f, b"tEXt", key.encode("latin-1") + b"\0" + value.encode("latin-1"))
+    except UnicodeError:
+        # Uncompressed, with empty language tag and translated keyword.
+        itxt_header = key.encode("latin-1") + b"\0" + b"\0\0" + b"\0" + b"\0"
+        _write_chunk(f, b"iTXt", itxt_header + value.encode("utf-8"))
+
+
+def _write_chunk(f, chunk_type: bytes, data: bytes):
+    f.write(struct.pack(">I", len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
@@ -1,15 +1,69 @@
+import time
+from typing import List, NamedTuple
+
+import numpy as np
 from PIL import Image
 from potrace import Bitmap, POTRACE_TURNPOLICY_MINORITY
 
 Image.MAX_IMAGE_PIXELS = None
 DECIMALS = 3
+BLACK_LEVEL = 0.5
+
+# Segments are formatted this many at a time, with one '%' format per batch, and each
+# batch written straight to the svg file so the path data is never all in memory.
+FORMAT_BATCH_SIZE = 4096
+
+POINT_FORMAT = f"%.{DECIMALS}f,%.{DECIMALS}f"
+MOVE_FORMAT = f"M{POINT_FORMAT}"
+CORNER_FORMAT = f"L{POINT_FORMAT}L{POINT_FORMAT}"
+BEZIER_FORMAT = f"C{POINT_FORMAT} {POINT_FORMAT} {POINT_FORMAT}"
+
+
+class PotraceSvg(NamedTuple):
+    curves: List
+    num_curves: int
+    trace_secs: float
+    write_secs: float
+
+
+# Returns the traced curves so the ink can be rasterized without reading the svg back.
+def image_file_to_svg(in_file: str, out_file: str) -> List:
+    with Image.open(in_file) as image:
+        gray_image = np.asarray(image.convert("L"))
+
+    return image_to_svg_file(gray_image < 255 * BLACK_LEVEL, out_file).curves
 
 
-def image_file_to_svg(in_file: str, out_file: str):
-    image = Image.open(in_file)
-    bitmap = Bitmap(image, blacklevel=0.5)
+# 'ink' is a bool image, True for ink.
+def image_to_svg_file(ink: np.ndarray, out_file: str) -> PotraceSvg:
+    start = time.perf_counter()
+    curves = get_potrace_curves(ink)
+    trace_secs = time.perf_counter() - start
 
-    plist = bitmap.trace(
+    start = time.perf_counter()
+    height, width = ink.shape
+    with open(out_file, "w") as fp:
+        xmlns = "http://www.w3.org/2000/svg"
+        xmlns_xlink = "http://www.w3.org/1999/xlink"
+        fp.write(
+            f'<svg version="1.1"'
+            f' xmlns="{xmlns}" xmlns:xlink="{xmlns_xlink}"'
+            f' width="{width}" height="{height}"'
+            f' viewBox="0 0 {width} {height}">'
+        )
+        fp.write('<path stroke="none" fill="black" fill-rule="evenodd" d="')
+        _write_path_data(fp, curves)
+        fp.write('"/>')
+        fp.write("</svg>")
+
+    return PotraceSvg(curves, len(curves), trace_secs, time.perf_counter() - start)
+
+
+def get_potrace_curves(ink: np.ndarray) -> List:
+    # Bitmap inverts its data, taking True as background.
+    bitmap = Bitmap(np.invert(ink), blacklevel=BLACK_LEVEL)
+
+    return bitmap.trace(
         turdsize=2,
         turnpolicy=POTRACE_TURNPOLICY_MINORITY,
         alphamax=1.2,
@@ -17,39 +71,32 @@ def image_file_to_svg(in_file: str, out_file: str):
         opttolerance=1.0,
     )
 
-    parts = []
-    for curve in plist:
-        fs = curve.start_point
-        parts.append(f"M{fs.x:.{DECIMALS}f},{fs.y:.{DECIMALS}f}")
+
+def _write_path_data(fp, curves: List):
+    formats = []
+    values = []
+
+    for curve in curves:
+        formats.append(MOVE_FORMAT)
+        values += (curve.start_point.x, curve.start_point.y)
 
         for segment in curve.segments:
+            end_point = segment.end_point
             if segment.is_corner:
-                a = segment.c
-                b = segment.end_point
-                parts.append(
-                    f"L{a.x:.{DECIMALS}f},{a.y:.{DECIMALS}f}"
-                    f"L{b.x:.{DECIMALS}f},{b.y:.{DECIMALS}f}"
-                )
+                formats.append(CORNER_FORMAT)
+                values += (segment.c.x, segment.c.y, end_point.x, end_point.y)
             else:
-                a = segment.c1
-                b = segment.c2
-                c = segment.end_point
-                parts.append(
-                    f"C{a.x:.{DECIMALS}f},{a.y:.{DECIMALS}f}"
-                    f" {b.x:.{DECIMALS}f},{b.y:.{DECIMALS}f}"
-                    f" {c.x:.{DECIMALS}f},{c.y:.{DECIMALS}f}"
-                )
+                formats.append(BEZIER_FORMAT)
+                c1 = segment.c1
+                c2 = segment.c2
+                values += (c1.x, c1.y, c2.x, c2.y, end_point.x, end_point.y)
 
-        parts.append("z")
+        formats.append("z")
 
-    with open(out_file, "w") as fp:
-        xmlns = "http://www.w3.org/2000/svg"
-        xmlns_xlink = "http://www.w3.org/1999/xlink"
-        fp.write(
-            f'<svg version="1.1"'
-            f' xmlns="{xmlns}" xmlns:xlink="{xmlns_xlink}"'
-            f' width="{image.width}" height="{image.height}"'
-            f' viewBox="0 0 {image.width} {image.height}">'
-        )
-        fp.write(f'<path stroke="none" fill="black" fill-rule="evenodd" d="{"".join(parts)}"/>')
-        fp.write("</svg>")
+        if len(formats) >= FORMAT_BATCH_SIZE:
+            fp.write("".join(formats) % tuple(values))
+            formats = []
+            values = []
+
+    if formats:
+        fp.write("".join(formats) % tuple(values))
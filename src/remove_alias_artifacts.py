@@ -1,16 +1,28 @@
 import os
+from typing import Optional
 
 import cv2 as cv
+import numba
 import numpy as np
-from numba import jit
+from numba import jit, prange
+
+from .tiling import apply_in_strips
 
 DEBUG = False
 DEBUG_OUTPUT_DIR = "/tmp"
 
+USE_PARALLEL_MEDIAN_FILTER = True
+# Threads for the parallel kernel on one page. Divide the cores by the number of pages
+# filtered at once.
+MEDIAN_FILTER_THREADS = os.cpu_count()
+
 MEDIAN_BLUR_APERTURE_SIZE = 7
 ADAPTIVE_THRESHOLD_BLOCK_SIZE = 21
 ADAPTIVE_THRESHOLD_CONST_SUBTRACT = 12  # Careful here with including alias artifacts
 
+# Rows of context needed by the ink mask adaptive threshold, the mask blur and the median.
+MEDIAN_FILTER_STRIP_HALO = ADAPTIVE_THRESHOLD_BLOCK_SIZE // 2 + 1 + MEDIAN_BLUR_APERTURE_SIZE // 2
+
 
 def _median_filter(
     original_image: cv.typing.MatLike, mask: cv.typing.MatLike, kernel_size: int
@@ -35,7 +47,10 @@ def _median_filter(
             wrapped_mask,
         )
 
-    _median_filter_core(wrapped_image, wrapped_mask, kernel_size, filtered_image)
+    if USE_PARALLEL_MEDIAN_FILTER:
+        _median_filter_core_parallel(wrapped_image, wrapped_mask, kernel_size, filtered_image)
+    else:
+        _median_filter_core(wrapped_image, wrapped_mask, kernel_size, filtered_image)
 
     #    median_filter_core.parallel_diagnostics(level=4)
 
@@ -84,7 +99,97 @@ def _get_median(num_nbrs: int, nbrs0, nbrs1, nbrs2):
     )
 
 
-def get_median_filter(input_image: cv.typing.MatLike) -> cv.typing.MatLike:
+# Gives identical output to '_median_filter_core' but each row keeps a sliding
+# per-channel histogram of the unmasked window pixels, so there are no per pixel
+# neighbour copies or sorts, and the rows are run in parallel.
+@jit(nopython=True, parallel=True)
+def _median_filter_core_parallel(wrapped_image, wrapped_mask, kernel_size: int, filtered_image):
+    image_h, image_w = filtered_image.shape[0], filtered_image.shape[1]
+    w: int = kernel_size // 2
+
+    for i in prange(w, image_h + w):
+        hist = np.zeros((3, 256), dtype=np.int32)
+        num_nbrs = 0
+
+        # Prime the window with all but the rightmost column of the first pixel's window.
+        for y in range(0, kernel_size - 1):
+            num_nbrs += _add_column_to_hist(wrapped_image, wrapped_mask, i - w, i + w, y, hist, 1)
+
+        for j in range(w, image_w + w):
+            num_nbrs += _add_column_to_hist(
+                wrapped_image, wrapped_mask, i - w, i + w, j + w, hist, 1
+            )
+
+            if wrapped_mask[i, j] > 0:
+                filtered_image[i - w, j - w] = wrapped_image[i, j]
+            elif num_nbrs == 0:
+                filtered_image[i - w, j - w] = (0, 100, 0)
+            else:
+                for c in range(3):
+                    filtered_image[i - w, j - w, c] = _get_hist_median(hist[c], num_nbrs)
+
+            num_nbrs += _add_column_to_hist(
+                wrapped_image, wrapped_mask, i - w, i + w, j - w, hist, -1
+            )
+
+
+@jit(nopython=True)
+def _add_column_to_hist(wrapped_image, wrapped_mask, x_start: int, x_end: int, y: int, hist, inc):
+    num_added = 0
+    for x in range(x_start, x_end + 1):
+        if wrapped_mask[x, y] > 0:
+            continue
+        pixel = wrapped_image[x, y]
+        hist[0, pixel[0]] += inc
+        hist[1, pixel[1]] += inc
+        hist[2, pixel[2]] += inc
+        num_added += inc
+
+    return num_added
+
+
+@jit(nopython=True)
+def _get_hist_median(channel_hist, num_nbrs: int) -> int:
+    # Same as 'np.median' truncated to an int: the mean of the two middle values
+    # when 'num_nbrs' is even.
+    lower_rank = (num_nbrs - 1) // 2
+    upper_rank = num_nbrs // 2
+
+    lower = -1
+    count = 0
+    for val in range(channel_hist.size):
+        count += channel_hist[val]
+        if lower < 0 and count > lower_rank:
+            lower = val
+        if count > upper_rank:
+            return (lower + val) // 2
+
+    return lower
+
+
+# 'out_image', if given, is where to write the filtered image - for example a memory
+# mapped work file.
+def get_median_filter(
+    input_image: cv.typing.MatLike,
+    out_image: Optional[cv.typing.MatLike] = None,
+    num_threads: int = MEDIAN_FILTER_THREADS,
+) -> cv.typing.MatLike:
+    filtered_image = np.empty_like(input_image) if out_image is None else out_image
+
+    # numba's thread count is kept per calling thread, so put it back afterwards.
+    saved_num_threads = numba.get_num_threads()
+    numba.set_num_threads(max(1, min(num_threads, numba.config.NUMBA_NUM_THREADS)))
+    try:
+        apply_in_strips(
+            _get_median_filter, [input_image], filtered_image, halo=MEDIAN_FILTER_STRIP_HALO
+        )
+    finally:
+        numba.set_num_threads(saved_num_threads)
+
+    return filtered_image
+
+
+def _get_median_filter(input_image: cv.typing.MatLike) -> cv.typing.MatLike:
     black_ink_mask = _get_black_ink_mask(input_image)
     if DEBUG:
         cv.imwrite(
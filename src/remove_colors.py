@@ -1,14 +1,19 @@
 import os
 from collections import OrderedDict
-from typing import Tuple, Dict
+from typing import Tuple, Dict, Optional
 
 import cv2 as cv
 import numpy as np
+from numba import jit, prange
 
-from .image_io import write_cv_image_file
+from .background_writer import get_background_writer
+from .image_io import ImageFileRole, write_cv_image_file
+from .tiling import apply_in_strips, get_strips
 
 DEBUG_WRITE_COLOR_COUNTS = True
 
+USE_FUSED_REMOVE_COLORS = True
+
 NUM_POSTERIZE_LEVELS = 5
 NUM_POSTERIZE_EXCEPTION_LEVELS = 2
 FIRST_LEVEL = int(255 / (NUM_POSTERIZE_LEVELS - 1))
@@ -34,30 +39,173 @@ def remove_colors(image: cv.typing.MatLike):
     image[colors_to_remove] = (255, 255, 255, 0)
 
 
-def get_color_counts(image: cv.typing.MatLike) -> Dict[Tuple[int, int, int], int]:
+def _get_colors_removed_image(posterized_image: cv.typing.MatLike) -> cv.typing.MatLike:
+    image = cv.cvtColor(posterized_image, cv.COLOR_RGB2RGBA)
+    remove_colors(image)
+    return image
+
+
+def _get_posterize_lut() -> np.ndarray:
+    lut = np.arange(256, dtype=np.uint8)
+    posterize_image(lut)
+    return lut
+
+
+POSTERIZE_LUT = _get_posterize_lut()
+POSTERIZED_VALUES = np.unique(POSTERIZE_LUT)
+# Index of each posterized value in 'POSTERIZED_VALUES' - used to count posterized colors.
+POSTERIZED_VALUE_INDEXES = np.searchsorted(POSTERIZED_VALUES, POSTERIZE_LUT).astype(np.int32)
+
+
+# One pass equivalent of 'posterize_image' followed by 'remove_colors' on an RGBA copy.
+# Returns the posterized image, the colors removed RGBA image and, if asked for, the
+# posterized and remaining color counts, exactly as 'get_color_counts' would give them.
+def posterize_and_remove_colors(
+    image: cv.typing.MatLike, get_counts: bool, out_image: Optional[cv.typing.MatLike] = None
+) -> Tuple[
+    cv.typing.MatLike,
+    cv.typing.MatLike,
+    Dict[Tuple[int, int, int], int],
+    Dict[Tuple[int, int, int], int],
+]:
+    assert image.shape[2] == 3
     image_h, image_w = image.shape[0], image.shape[1]
 
-    all_colors = dict()
+    posterized_image = np.empty_like(image)
+    if out_image is None:
+        colors_removed_image = np.empty((image_h, image_w, 4), dtype=image.dtype)
+    else:
+        colors_removed_image = out_image
+
+    num_values = POSTERIZED_VALUES.size
+    num_colors = num_values**3
+    row_counts = np.zeros((image_h if get_counts else 0, num_colors), dtype=np.int32)
+    row_first_cols = np.zeros((image_h if get_counts else 0, num_colors), dtype=np.int32)
+
+    _posterize_and_remove_colors_core(
+        image,
+        POSTERIZE_LUT,
+        POSTERIZED_VALUE_INDEXES,
+        FIRST_LEVEL,
+        get_counts,
+        posterized_image,
+        np.asarray(colors_removed_image),
+        row_counts,
+        row_first_cols,
+    )
+
+    if not get_counts:
+        return posterized_image, colors_removed_image, dict(), dict()
 
-    for i in range(0, image_h):  ## traverse image row
-        for j in range(0, image_w):  ## traverse image col
-            pixel = image[i][j]
-            red = int(pixel[2])
-            green = int(pixel[1])
-            blue = int(pixel[0])
+    # Raster position where each posterized color is first seen.
+    row_starts = np.arange(image_h, dtype=np.int64)[:, np.newaxis] * image_w
+    first_positions = np.where(
+        row_counts > 0, row_starts + row_first_cols, np.iinfo(np.int64).max
+    ).min(axis=0)
+    counts = row_counts.sum(axis=0, dtype=np.int64)
+    del row_counts, row_first_cols
 
-            color = (red, green, blue)
+    posterized_counts = dict()
+    remaining_counts = dict()
+    for index in np.argsort(first_positions, kind="stable").tolist():
+        if counts[index] == 0:
+            continue
+        b = int(POSTERIZED_VALUES[index % num_values])
+        g = int(POSTERIZED_VALUES[(index // num_values) % num_values])
+        r = int(POSTERIZED_VALUES[index // (num_values * num_values)])
+        count = int(counts[index])
 
-            if color in all_colors:
-                all_colors[color] += 1
+        posterized_counts[(r, g, b)] = count
+
+        if r > FIRST_LEVEL or g > FIRST_LEVEL or b > FIRST_LEVEL:
+            r, g, b = 255, 255, 255
+        remaining_counts[(r, g, b)] = remaining_counts.get((r, g, b), 0) + count
+
+    return posterized_image, colors_removed_image, posterized_counts, remaining_counts
+
+
+@jit(nopython=True, parallel=True)
+def _posterize_and_remove_colors_core(
+    image,
+    lut,
+    value_indexes,
+    first_level: int,
+    get_counts: bool,
+    posterized_image,
+    colors_removed_image,
+    row_counts,
+    row_first_cols,
+):
+    image_h, image_w = image.shape[0], image.shape[1]
+    num_values = value_indexes.max() + 1
+
+    for i in prange(image_h):
+        for j in range(image_w):
+            b = lut[image[i, j, 0]]
+            g = lut[image[i, j, 1]]
+            r = lut[image[i, j, 2]]
+
+            posterized_image[i, j, 0] = b
+            posterized_image[i, j, 1] = g
+            posterized_image[i, j, 2] = r
+
+            if b > first_level or g > first_level or r > first_level:
+                colors_removed_image[i, j, 0] = 255
+                colors_removed_image[i, j, 1] = 255
+                colors_removed_image[i, j, 2] = 255
+                colors_removed_image[i, j, 3] = 0
             else:
-                all_colors[color] = 1
+                colors_removed_image[i, j, 0] = b
+                colors_removed_image[i, j, 1] = g
+                colors_removed_image[i, j, 2] = r
+                colors_removed_image[i, j, 3] = 255
+
+            if get_counts:
+                color_index = (
+                    value_indexes[r] * num_values + value_indexes[g]
+                ) * num_values + value_indexes[b]
+                if row_counts[i, color_index] == 0:
+                    row_first_cols[i, color_index] = j
+                row_counts[i, color_index] += 1
+
+
+def get_color_counts(image: cv.typing.MatLike) -> Dict[Tuple[int, int, int], int]:
+    # Count each strip's colors in one 'np.unique' pass over the BGR values packed
+    # into uint32's. Any alpha channel is ignored. Colors are added in the order
+    # they are first seen in the image, the same order as a pixel by pixel count.
+    all_colors = dict()
+
+    for strip in get_strips(image.shape[0], halo=0):
+        packed_colors = _get_packed_colors(image[strip.start : strip.end])
+        colors, first_indices, counts = np.unique(
+            packed_colors, return_index=True, return_counts=True
+        )
+
+        first_seen_order = np.argsort(first_indices)
+        for color, count in zip(
+            colors[first_seen_order].tolist(), counts[first_seen_order].tolist()
+        ):
+            rgb = ((color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF)
+            all_colors[rgb] = all_colors.get(rgb, 0) + count
 
     return all_colors
 
 
+def _get_packed_colors(image: cv.typing.MatLike) -> np.ndarray:
+    pixels = image.reshape(-1, image.shape[2])
+
+    packed_colors = pixels[:, 2].astype(np.uint32) << 16
+    packed_colors |= pixels[:, 1].astype(np.uint32) << 8
+    packed_colors |= pixels[:, 0]
+
+    return packed_colors
+
+
 def write_color_counts(filename: str, image: cv.typing.MatLike):
-    color_counts = get_color_counts(image)
+    write_color_counts_file(filename, get_color_counts(image))
+
+
+def write_color_counts_file(filename: str, color_counts: Dict[Tuple[int, int, int], int]):
     color_counts_descending = OrderedDict(
         sorted(color_counts.items(), key=lambda kv: kv[1], reverse=True)
     )
@@ -67,27 +215,66 @@ def write_color_counts(filename: str, image: cv.typing.MatLike):
 
 
 def remove_colors_from_image(work_dir: str, work_file_stem: str, in_file: str, out_file: str):
-    out_image = cv.imread(in_file)
+    out_image = get_colors_removed_image(work_dir, work_file_stem, cv.imread(in_file), True)
+
+    write_cv_image_file(out_file, out_image)
+    get_background_writer().wait()
 
-    posterize_image(out_image)
-    posterized_image_file = os.path.join(
-        work_dir, work_file_stem + "-posterized-pre-remove-colors.png"
-    )
-    write_cv_image_file(posterized_image_file, out_image)
 
-    if DEBUG_WRITE_COLOR_COUNTS:
+# The debug files are written in the background - see 'BackgroundWriter'. 'out_image', if
+# given, is where to write the BGRA colors removed image - for example a memory mapped
+# work file.
+def get_colors_removed_image(
+    work_dir: str,
+    work_file_stem: str,
+    in_image: cv.typing.MatLike,
+    write_debug_files: bool,
+    out_image: Optional[cv.typing.MatLike] = None,
+) -> cv.typing.MatLike:
+    write_color_counts_files = write_debug_files and DEBUG_WRITE_COLOR_COUNTS
+
+    if USE_FUSED_REMOVE_COLORS:
+        posterized_image, out_image, posterized_counts, remaining_counts = (
+            posterize_and_remove_colors(in_image, write_color_counts_files, out_image)
+        )
+    else:
+        posterized_image = in_image.copy()
+        apply_in_strips(posterize_image, [posterized_image])
+
+        if out_image is None:
+            out_image = np.empty((*posterized_image.shape[:2], 4), dtype=posterized_image.dtype)
+        apply_in_strips(_get_colors_removed_image, [posterized_image], out_image)
+
+        if write_color_counts_files:
+            posterized_counts = get_color_counts(posterized_image)
+            remaining_counts = get_color_counts(out_image)
+
+    if write_debug_files:
+        posterized_image_file = os.path.join(
+            work_dir, work_file_stem + "-posterized-pre-remove-colors.png"
+        )
+        get_background_writer().submit(
+            posterized_image.nbytes,
+            write_cv_image_file,
+            posterized_image_file,
+            posterized_image,
+            role=ImageFileRole.EXTERNAL,
+        )
+    del posterized_image
+
+    if write_color_counts_files:
         posterized_counts_file = os.path.join(
             work_dir, work_file_stem + "-posterized-color-counts-pre-remove-colors.txt"
         )
-        write_color_counts(posterized_counts_file, out_image)
-
-    out_image = cv.cvtColor(out_image, cv.COLOR_RGB2RGBA)
-    remove_colors(out_image)
+        get_background_writer().submit(
+            0, write_color_counts_file, posterized_counts_file, posterized_counts
+        )
 
-    if DEBUG_WRITE_COLOR_COUNTS:
         remaining_color_counts_file = os.path.join(
             work_dir, work_file_stem + "-remaining-color-counts-post-remove-colors.txt"
         )
-        write_color_counts(remaining_color_counts_file, out_image)
+        get_background_writer().submit(
+            0, write_color_counts_file, remaining_color_counts_file, remaining_counts
+        )
 
-    write_cv_image_file(out_file, out_image)
+    return out_image
@@ -1,21 +1,100 @@
 import logging
 import os
 import time
+from enum import Enum
+from functools import wraps
 from pathlib import Path
-from typing import List, Union
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
 
 import cv2 as cv
+import numpy as np
+from PIL import Image
 
 from barks_fantagraphics.comics_utils import get_clean_path
-from .image_io import svg_file_to_png, resize_image_file, write_cv_image_file
-from .inpaint import inpaint_image_file
-from .overlay import overlay_inpainted_file_with_black_ink
-from .remove_alias_artifacts import get_median_filter
-from .remove_colors import remove_colors_from_image
-from .smooth_image import smooth_image_file
-from .vtracer_to_svg import image_file_to_svg
-
-USE_EXISTING_WORK_FILES = False  # Use with care
+from .background_writer import get_background_writer
+from .gmic_exe import run_gmic_on_images
+from .image_io import (
+    ImageFileRole,
+    get_image_file_ext,
+    get_work_image_buffer,
+    read_cv_image_file,
+    write_cv_image_file,
+    write_resized_image_file,
+)
+from .inpaint import INPAINT_METHOD, INPAINT_THREADS, InpaintMethod, inpaint_image
+from .ink_mask import get_black_ink_image, get_ink_mask_from_potrace_curves
+from .overlay import overlay_inpainted_image_with_black_ink
+from .panels import get_cached_panels, get_panel_work_tiles
+from .png_encoder import write_png
+from .potrace_to_svg import BLACK_LEVEL, image_to_svg_file
+from .remove_alias_artifacts import MEDIAN_FILTER_THREADS, get_median_filter
+from .remove_colors import get_colors_removed_image
+from .smooth_image import smooth_image
+from .stage_cache import StageCache, get_stage_key
+from .stage_trace import trace_stage
+from .tiling import Tile, apply_in_strips
+from .vtracer_to_svg import (
+    TRACE_TILE_SIZE,
+    TRACE_WORKERS,
+    USE_TILED_TRACING,
+    get_trace_tiles,
+    image_to_svg_in_tiles,
+)
+
+# Skip stages whose outputs were made from the same inputs, parameters and code.
+USE_STAGE_CACHE = True
+# The overlay uses an in memory ink mask. Only write the png of the svg for viewing.
+SAVE_PNG_OF_SVG = False
+# Trace the ink panel by panel, skipping the gutters, rather than in a plain tile grid.
+USE_PANEL_TRACING = True
+# Trace the ink with potrace rather than vtracer. potrace is slower, and traces the whole
+# page in one go.
+USE_POTRACE = False
+
+STAGE_REMOVE_JPG_ARTIFACTS = "remove-jpg-artifacts"
+STAGE_REMOVE_COLORS = "remove-colors"
+STAGE_SMOOTH = "smooth-removed-colors"
+STAGE_GENERATE_SVG = "generate-svg"
+STAGE_INPAINT = "inpaint"
+STAGE_OVERLAY = "overlay-inpaint-with-black-ink"
+STAGE_RESIZE = "resize-restored-file"
+
+
+# Stages pass images to each other in memory. This controls which work files
+# are also written to the work directory.
+class PersistPolicy(Enum):
+    # No work files, so every part has to run in this process.
+    NONE = 0
+    # Plus the final work file of each part, so later parts can be run in
+    # another process or another run.
+    FINAL_ONLY = 1
+    # Plus every intermediate and debug work file.
+    ALL_FOR_DEBUG = 2
+
+
+class _Stage(NamedTuple):
+    # The files that must exist for the stage to be skipped. No outputs means the
+    # stage results are only kept in memory and the stage is never skipped on its own.
+    outputs: List[str]
+    upstream_stages: List[str]
+    input_files: List[str]
+    stage_funcs: List[Callable]
+    params: Dict[str, Any]
+
+
+# Trace a stage method to the pipeline's trace file. A stage catches its own errors, so
+# the page's 'errors_occurred' is recorded with it.
+def _traced_stage(stage: str):
+    def decorator(stage_method: Callable[["RestorePipeline"], None]):
+        @wraps(stage_method)
+        def traced_stage_method(self: "RestorePipeline"):
+            with trace_stage(self.trace_file, stage, self.srce_upscale_file.name) as record:
+                stage_method(self)
+                record["errors_occurred"] = self.errors_occurred
+
+        return traced_stage_method
+
+    return decorator
 
 
 class RestorePipeline:
@@ -28,6 +107,12 @@ class RestorePipeline:
         dest_restored_file: Path,
         dest_upscayled_restored_file: Path,
         dest_svg_restored_file: Path,
+        persist_policy: PersistPolicy = PersistPolicy.ALL_FOR_DEBUG,
+        trace_file: str = "",
+        inpaint_method: InpaintMethod = INPAINT_METHOD,
+        inpaint_threads: int = INPAINT_THREADS,
+        trace_workers: int = TRACE_WORKERS,
+        median_filter_threads: int = MEDIAN_FILTER_THREADS,
     ):
         self.work_dir = work_dir
         self.out_dir = os.path.dirname(dest_restored_file)
@@ -38,8 +123,21 @@ class RestorePipeline:
         self.dest_upscayled_restored_file = str(dest_upscayled_restored_file)
         self.dest_svg_restored_file = str(dest_svg_restored_file)
 
+        self.persist_policy = persist_policy
+        self.persist_part_outputs = persist_policy != PersistPolicy.NONE
+        self.persist_debug_files = persist_policy == PersistPolicy.ALL_FOR_DEBUG
+        self.trace_file = trace_file
+        self.inpaint_method = inpaint_method
+        self.inpaint_threads = inpaint_threads
+        self.trace_workers = trace_workers
+        self.median_filter_threads = median_filter_threads
+
         self.errors_occurred = False
 
+        # Images passed between stages run in this process, keyed by work file.
+        self._images: Dict[str, cv.typing.MatLike] = dict()
+        self.work_files_removed = False
+
         if not os.path.isdir(self.work_dir):
             raise Exception(f'Work directory not found: "{self.work_dir}".')
         if not os.path.isdir(self.out_dir):
@@ -51,191 +149,537 @@ class RestorePipeline:
 
         self.srce_upscale_stem = f"{self.srce_upscale_file.stem}-upscayled"
 
+        # Work files only this pipeline reads are raw arrays. The png of the svg is for viewing.
+        work_ext = get_image_file_ext(ImageFileRole.WORK)
+        external_ext = get_image_file_ext(ImageFileRole.EXTERNAL)
         self.removed_artifacts_file = os.path.join(
-            work_dir, f"{self.srce_upscale_stem}-median-filtered.png"
+            work_dir, f"{self.srce_upscale_stem}-median-filtered{work_ext}"
         )
         self.removed_colors_file = os.path.join(
-            work_dir, f"{self.srce_upscale_stem}-color-removed.png"
+            work_dir, f"{self.srce_upscale_stem}-color-removed{work_ext}"
         )
         self.smoothed_removed_colors_file = os.path.join(
-            work_dir, f"{self.srce_upscale_stem}-color-removed-smoothed.png"
+            work_dir, f"{self.srce_upscale_stem}-color-removed-smoothed{work_ext}"
+        )
+        self.png_of_svg_file = self.dest_svg_restored_file + external_ext
+        self.ink_mask_file = os.path.join(work_dir, f"{self.srce_upscale_stem}-ink-mask{work_ext}")
+        self.panels_file = os.path.join(work_dir, f"{self.srce_upscale_stem}-panels.json")
+        self.inpainted_file = os.path.join(
+            work_dir, f"{self.srce_upscale_stem}-inpainted{work_ext}"
+        )
+
+        self._stage_cache = StageCache(
+            os.path.join(work_dir, f"{self.srce_upscale_stem}-stage-cache.json")
         )
-        self.png_of_svg_file = self.dest_svg_restored_file + ".png"
-        self.inpainted_file = os.path.join(work_dir, f"{self.srce_upscale_stem}-inpainted.png")
+        self._stage_keys: Dict[str, str] = dict()
+        self._stages = self._get_stages()
+
+    # Only the image header is read.
+    def get_megapixels(self) -> float:
+        with Image.open(self.srce_upscale_file) as image:
+            width, height = image.size
+
+        return width * height / 1e6
+
+    def _get_stages(self) -> Dict[str, _Stage]:
+        def persisted(files: List[str], persist: bool) -> List[str]:
+            return files if persist else []
+
+        return {
+            STAGE_REMOVE_JPG_ARTIFACTS: _Stage(
+                persisted([self.removed_artifacts_file], self.persist_debug_files),
+                [],
+                [str(self.srce_upscale_file)],
+                [get_median_filter, apply_in_strips],
+                dict(),
+            ),
+            STAGE_REMOVE_COLORS: _Stage(
+                persisted([self.removed_colors_file], self.persist_part_outputs),
+                [STAGE_REMOVE_JPG_ARTIFACTS],
+                [],
+                [get_colors_removed_image, apply_in_strips, write_cv_image_file],
+                dict(),
+            ),
+            STAGE_SMOOTH: _Stage(
+                persisted([self.smoothed_removed_colors_file], self.persist_part_outputs),
+                [STAGE_REMOVE_COLORS],
+                [],
+                [smooth_image, run_gmic_on_images],
+                dict(),
+            ),
+            STAGE_GENERATE_SVG: _Stage(
+                [self.dest_svg_restored_file]
+                + persisted([self.ink_mask_file], self.persist_part_outputs)
+                + persisted([self.png_of_svg_file], SAVE_PNG_OF_SVG),
+                [STAGE_SMOOTH],
+                [],
+                [
+                    image_to_svg_in_tiles,
+                    get_cached_panels,
+                    get_black_ink_image,
+                    Tile,
+                    image_to_svg_file,
+                ],
+                {
+                    "use_panel_tracing": USE_PANEL_TRACING,
+                    "use_potrace": USE_POTRACE,
+                    "save_png_of_svg": SAVE_PNG_OF_SVG,
+                },
+            ),
+            STAGE_INPAINT: _Stage(
+                persisted([self.inpainted_file], self.persist_part_outputs),
+                [STAGE_REMOVE_COLORS],
+                [str(self.srce_upscale_file)],
+                [inpaint_image, apply_in_strips, run_gmic_on_images],
+                {"inpaint_method": self.inpaint_method.name},
+            ),
+            STAGE_OVERLAY: _Stage(
+                [self.dest_upscayled_restored_file],
+                [STAGE_INPAINT, STAGE_GENERATE_SVG],
+                [],
+                [
+                    overlay_inpainted_image_with_black_ink,
+                    apply_in_strips,
+                    get_black_ink_image,
+                    run_gmic_on_images,
+                ],
+                dict(),
+            ),
+            STAGE_RESIZE: _Stage(
+                [self.dest_restored_file],
+                [STAGE_OVERLAY],
+                [],
+                [write_resized_image_file, write_png],
+                self._get_restored_file_metadata(),
+            ),
+        }
+
+    def _get_stage_key(self, stage: str) -> str:
+        if stage not in self._stage_keys:
+            stage_info = self._stages[stage]
+            input_keys = [self._get_stage_key(upstream) for upstream in stage_info.upstream_stages]
+            input_keys += [self._stage_cache.get_file_key(f) for f in stage_info.input_files]
+
+            self._stage_keys[stage] = get_stage_key(
+                stage, input_keys, stage_info.params, stage_info.stage_funcs
+            )
+
+        return self._stage_keys[stage]
+
+    def _is_stage_up_to_date(self, stage: str) -> bool:
+        outputs = self._stages[stage].outputs
+        if not outputs or not all(os.path.isfile(f) for f in outputs):
+            return False
+
+        return self._stage_cache.get_stage_key(stage) == self._get_stage_key(stage)
+
+    # A stage can be skipped if it's up to date or if every stage that uses its
+    # outputs can be skipped.
+    def _can_skip_stage(self, stage: str) -> bool:
+        if self._is_stage_up_to_date(stage):
+            return True
+
+        downstream_stages = [
+            downstream
+            for downstream, stage_info in self._stages.items()
+            if stage in stage_info.upstream_stages
+        ]
+
+        return bool(downstream_stages) and all(
+            self._can_skip_stage(downstream) for downstream in downstream_stages
+        )
+
+    def _skip_stage(self, stage: str) -> bool:
+        if not USE_STAGE_CACHE or not self._can_skip_stage(stage):
+            return False
+
+        reason = "up to date" if self._is_stage_up_to_date(stage) else "not needed"
+        logging.warning(
+            f'Stage "{stage}" is {reason} for "{self.srce_upscale_file.name}" - skipping.'
+        )
+        return True
+
+    # A stage's outputs are overwritten in place, so its key goes before it touches them. A
+    # stage that fails part way then isn't taken as up to date on a later run.
+    def _set_stage_started(self, stage: str):
+        self._stage_cache.remove_stage_key(stage)
+
+    def _set_stage_done(self, stage: str):
+        outputs = self._stages[stage].outputs
+        if outputs and all(os.path.isfile(f) for f in outputs):
+            self._stage_cache.set_stage_key(stage, self._get_stage_key(stage))
+        else:
+            self._stage_cache.remove_stage_key(stage)
+
+    def get_persisted_work_files(self) -> List[str]:
+        work_files = []
+        if self.persist_debug_files:
+            work_files.append(self.removed_artifacts_file)
+        if self.persist_part_outputs:
+            work_files.extend(
+                [
+                    self.removed_colors_file,
+                    self.smoothed_removed_colors_file,
+                    self.ink_mask_file,
+                    self.inpainted_file,
+                ]
+            )
+        if SAVE_PNG_OF_SVG:
+            work_files.append(self.png_of_svg_file)
+
+        if self.work_files_removed:
+            return [f for f in work_files if self._get_file_role(f) != ImageFileRole.WORK]
+
+        return work_files
+
+    # The '.npy' work files take around 1 GB for a 4x page, and are only read by the page's
+    # later stages, so they can go once the page is restored. The stage cache then can't
+    # skip the stages that made them on a re-run. Debug runs keep everything.
+    def remove_work_files(self):
+        if self.persist_policy == PersistPolicy.ALL_FOR_DEBUG:
+            return
+
+        work_files = self.get_persisted_work_files()
+        self.work_files_removed = True
+
+        for work_file in work_files:
+            if work_file not in self.get_persisted_work_files() and os.path.isfile(work_file):
+                os.remove(work_file)
+
+    def _get_image(self, file: str, flags: int = cv.IMREAD_COLOR) -> cv.typing.MatLike:
+        if file not in self._images:
+            self._images[file] = read_cv_image_file(file, flags)
+
+        return self._images[file]
+
+    def _put_image(self, file: str, image: cv.typing.MatLike, persist: bool):
+        self._images[file] = image
+
+        if persist:
+            self._persist_image(file)
+
+    # A stage output that will be persisted as a work file is written straight through to
+    # the memory mapped file, so the stage never holds the whole output page in memory.
+    def _get_out_image(
+        self, file: str, shape: Tuple[int, ...], dtype: np.dtype, persist: bool
+    ) -> cv.typing.MatLike:
+        if persist and self._get_file_role(file) == ImageFileRole.WORK:
+            return get_work_image_buffer(file, shape, dtype)
+
+        return np.empty(shape, dtype)
+
+    def _persist_image(self, file: str):
+        write_cv_image_file(file, self._images[file], role=self._get_file_role(file))
+
+    def _get_file_role(self, file: str) -> ImageFileRole:
+        if file in [self.dest_upscayled_restored_file, self.dest_restored_file]:
+            return ImageFileRole.DELIVERABLE
+        if os.path.splitext(file)[1] == get_image_file_ext(ImageFileRole.WORK):
+            return ImageFileRole.WORK
+        return ImageFileRole.EXTERNAL
+
+    def _release_image(self, file: str):
+        self._images.pop(file, None)
+
+    def release_images(self):
+        self._images.clear()
+
+    def _get_restored_file_metadata(self) -> Dict[str, str]:
+        # TODO: Save other params used in process.
+        return {
+            "Source file": f'"{get_clean_path(self.srce_file)}"',
+            "Upscayl file": f'"{get_clean_path(self.srce_upscale_file)}"',
+            "Upscayl scale": str(self.scale),
+        }
 
     def do_part1(self):
         self.do_remove_jpg_artifacts()
         self.do_remove_colors()
+        self._wait_for_background_writes()
 
     def do_part2_memory_hungry(self):
         self.do_smooth_removed_colors()
+        self._wait_for_background_writes()
 
     def do_part3(self):
         self.do_generate_svg()
+        self._wait_for_background_writes()
 
     def do_part4_memory_hungry(self):
         self.do_inpaint()
         self.do_overlay_inpaint_with_black_ink()
         self.do_resize_restored_file()
+        self._wait_for_background_writes()
+        self.release_images()
+
+    # Stages hand their debug files to the background writer and carry on. The files are
+    # only waited for when the page's part is done.
+    def _wait_for_background_writes(self):
+        try:
+            get_background_writer().wait()
+        except Exception as e:
+            self.errors_occurred = True
+            logging.exception(e)
 
+    @_traced_stage(STAGE_REMOVE_JPG_ARTIFACTS)
     def do_remove_jpg_artifacts(self):
-        if USE_EXISTING_WORK_FILES and os.path.isfile(self.removed_artifacts_file):
-            logging.warning(
-                f"Removed artifacts file already exists - skipping:"
-                f' "{self.removed_artifacts_file}".'
-            )
+        if self._skip_stage(STAGE_REMOVE_JPG_ARTIFACTS):
             return
 
         try:
+            self._set_stage_started(STAGE_REMOVE_JPG_ARTIFACTS)
+
             start = time.time()
             logging.info(
                 f'\nGenerating file with jpeg artifacts removed: "{self.removed_artifacts_file}"...'
             )
 
-            upscale_image = cv.imread(str(self.srce_upscale_file))
-            out_image = get_median_filter(upscale_image)
-            write_cv_image_file(self.removed_artifacts_file, out_image)
+            upscale_image = self._get_image(str(self.srce_upscale_file))
+            out_image = get_median_filter(
+                upscale_image,
+                self._get_out_image(
+                    self.removed_artifacts_file,
+                    upscale_image.shape,
+                    upscale_image.dtype,
+                    self.persist_debug_files,
+                ),
+                self.median_filter_threads,
+            )
+            self._put_image(self.removed_artifacts_file, out_image, self.persist_debug_files)
 
             logging.info(
                 f"Time taken to remove jpeg artifacts for"
                 f' "{os.path.basename(self.removed_artifacts_file)}":'
                 f" {int(time.time() - start)}s."
             )
+
+            self._set_stage_done(STAGE_REMOVE_JPG_ARTIFACTS)
         except Exception as e:
             self.errors_occurred = True
             logging.exception(e)
 
+    @_traced_stage(STAGE_REMOVE_COLORS)
     def do_remove_colors(self):
-        if USE_EXISTING_WORK_FILES and os.path.isfile(self.removed_colors_file):
-            logging.warning(
-                f"Removed colors file already exists - skipping:" f' "{self.removed_colors_file}".'
-            )
+        if self._skip_stage(STAGE_REMOVE_COLORS):
             return
 
         try:
+            self._set_stage_started(STAGE_REMOVE_COLORS)
+
             start = time.time()
             logging.info(f'\nGenerating color removed file "{self.removed_colors_file}"...')
 
-            remove_colors_from_image(
+            removed_artifacts_image = self._get_image(self.removed_artifacts_file)
+            out_image = get_colors_removed_image(
                 self.work_dir,
                 self.srce_upscale_stem,
-                self.removed_artifacts_file,
-                self.removed_colors_file,
+                removed_artifacts_image,
+                self.persist_debug_files,
+                self._get_out_image(
+                    self.removed_colors_file,
+                    (*removed_artifacts_image.shape[:2], 4),
+                    removed_artifacts_image.dtype,
+                    self.persist_part_outputs,
+                ),
             )
+            self._put_image(self.removed_colors_file, out_image, self.persist_part_outputs)
+            self._release_image(self.removed_artifacts_file)
 
             logging.info(
                 f'Time taken to remove colors for "{os.path.basename(self.removed_colors_file)}":'
                 f" {int(time.time() - start)}s."
             )
+
+            self._set_stage_done(STAGE_REMOVE_COLORS)
         except Exception as e:
             self.errors_occurred = True
             logging.exception(e)
 
+    @_traced_stage(STAGE_SMOOTH)
     def do_smooth_removed_colors(self):
-        if USE_EXISTING_WORK_FILES and os.path.isfile(self.smoothed_removed_colors_file):
-            logging.warning(
-                f"Smoothed removed colors file already exists - skipping:"
-                f' "{self.smoothed_removed_colors_file}".'
-            )
+        if self._skip_stage(STAGE_SMOOTH):
             return
 
         try:
+            self._set_stage_started(STAGE_SMOOTH)
+
             start = time.time()
             logging.info(f'\nGenerating smoothed file "{self.smoothed_removed_colors_file}"...')
 
-            smooth_image_file(self.removed_colors_file, self.smoothed_removed_colors_file)
+            # Keep any alpha channel - the smoothing and inpainting ignore it, and the
+            # memory mapped work file is then used without a copy.
+            out_image = smooth_image(self._get_image(self.removed_colors_file, cv.IMREAD_UNCHANGED))
+            self._put_image(self.smoothed_removed_colors_file, out_image, self.persist_part_outputs)
 
             logging.info(
                 f'Time taken to smooth "{os.path.basename(self.smoothed_removed_colors_file)}":'
                 f" {int(time.time() - start)}s."
             )
+
+            self._set_stage_done(STAGE_SMOOTH)
         except Exception as e:
             self.errors_occurred = True
             logging.exception(e)
 
+    @_traced_stage(STAGE_GENERATE_SVG)
     def do_generate_svg(self):
+        if self._skip_stage(STAGE_GENERATE_SVG):
+            return
+
         try:
+            self._set_stage_started(STAGE_GENERATE_SVG)
+
             start = time.time()
             logging.info(f'\nGenerating svg file "{self.dest_svg_restored_file}"...')
 
-            # potrace_to_svg.image_file_to_svg(self.smoothed_removed_colors_file, self.dest_svg_restored_file)
-            image_file_to_svg(self.smoothed_removed_colors_file, self.dest_svg_restored_file)
+            # The overlay only needs the ink alpha, rasterized straight from the traced paths.
+            smoothed_image = self._get_image(self.smoothed_removed_colors_file)
+            if USE_POTRACE:
+                ink_mask = self._generate_potrace_svg(smoothed_image)
+            else:
+                ink_mask = self._generate_vtracer_svg(smoothed_image)
+            self._release_image(self.smoothed_removed_colors_file)
 
             logging.info(
                 f'Time taken to generate svg "{os.path.basename(self.dest_svg_restored_file)}":'
                 f" {int(time.time() - start)}s."
             )
 
-            logging.info(f'\nSaving svg file to png file "{self.png_of_svg_file}"...')
-            svg_file_to_png(self.dest_svg_restored_file, self.png_of_svg_file)
+            self._put_image(self.ink_mask_file, ink_mask, self.persist_part_outputs)
+
+            if SAVE_PNG_OF_SVG:
+                logging.info(f'\nSaving svg file to png file "{self.png_of_svg_file}"...')
+                write_cv_image_file(
+                    self.png_of_svg_file, get_black_ink_image(ink_mask), role=ImageFileRole.EXTERNAL
+                )
+
+            self._set_stage_done(STAGE_GENERATE_SVG)
         except Exception as e:
             self.errors_occurred = True
             logging.exception(e)
 
+    def _generate_vtracer_svg(self, smoothed_image: cv.typing.MatLike) -> np.ndarray:
+        trace_tiles = self._get_trace_tiles(smoothed_image)
+        vtracer_svg = image_to_svg_in_tiles(
+            smoothed_image, trace_tiles, num_workers=self.trace_workers
+        )
+        with open(self.dest_svg_restored_file, "w") as f:
+            f.write(vtracer_svg.svg)
+
+        logging.info(
+            f"Traced {vtracer_svg.num_paths} paths in {len(trace_tiles)} tiles with vtracer"
+            f" in {vtracer_svg.trace_secs:.1f}s."
+        )
+
+        return vtracer_svg.ink_mask
+
+    def _generate_potrace_svg(self, smoothed_image: cv.typing.MatLike) -> np.ndarray:
+        gray_image = cv.cvtColor(smoothed_image, cv.COLOR_BGR2GRAY)
+        potrace_svg = image_to_svg_file(gray_image < 255 * BLACK_LEVEL, self.dest_svg_restored_file)
+
+        logging.info(
+            f"Traced {potrace_svg.num_curves} curves with potrace in"
+            f" {potrace_svg.trace_secs:.1f}s (writing {potrace_svg.write_secs:.1f}s)."
+        )
+
+        height, width = gray_image.shape
+        return get_ink_mask_from_potrace_curves(potrace_svg.curves, width, height)
+
+    def _get_trace_tiles(self, smoothed_image: cv.typing.MatLike) -> List[Tile]:
+        if not USE_PANEL_TRACING:
+            return get_trace_tiles(smoothed_image.shape[1], smoothed_image.shape[0])
+
+        panels = get_cached_panels(
+            self.panels_file, self._get_stage_key(STAGE_SMOOTH), smoothed_image
+        )
+        logging.info(f"Found {len(panels)} panels to trace.")
+
+        # Without tiled tracing, each panel is traced whole.
+        max_tile_size = TRACE_TILE_SIZE if USE_TILED_TRACING else max(smoothed_image.shape[:2])
+
+        return get_panel_work_tiles(panels, max_tile_size)
+
+    @_traced_stage(STAGE_INPAINT)
     def do_inpaint(self):
-        if USE_EXISTING_WORK_FILES and os.path.isfile(self.inpainted_file):
-            logging.warning(
-                f"Inpainted file already exists - skipping:" f' "{self.inpainted_file}".'
-            )
+        if self._skip_stage(STAGE_INPAINT):
             return
 
         try:
+            self._set_stage_started(STAGE_INPAINT)
+
             start = time.time()
             logging.info(f'\nInpainting upscayled file to "{self.inpainted_file}"...')
 
-            inpaint_image_file(
+            out_image = inpaint_image(
                 self.work_dir,
                 self.srce_upscale_stem,
-                str(self.srce_upscale_file),
-                self.removed_colors_file,
-                self.inpainted_file,
+                self._get_image(str(self.srce_upscale_file)),
+                self._get_image(self.removed_colors_file, cv.IMREAD_UNCHANGED),
+                self.persist_debug_files,
+                self.inpaint_method,
+                self.inpaint_threads,
             )
+            self._put_image(self.inpainted_file, out_image, self.persist_part_outputs)
 
             logging.info(
                 f'Time taken to inpaint "{os.path.basename(self.inpainted_file)}":'
                 f" {int(time.time() - start)}s."
             )
+
+            self._set_stage_done(STAGE_INPAINT)
         except Exception as e:
             self.errors_occurred = True
             logging.exception(e)
 
+    @_traced_stage(STAGE_OVERLAY)
     def do_overlay_inpaint_with_black_ink(self):
+        if self._skip_stage(STAGE_OVERLAY):
+            return
+
         try:
+            self._set_stage_started(STAGE_OVERLAY)
+
             start = time.time()
             logging.info(
                 f'\nOverlaying inpainted file "{self.inpainted_file}"'
-                f' with black ink file "{self.png_of_svg_file}"...'
+                f' with black ink mask "{self.ink_mask_file}"...'
             )
 
-            overlay_inpainted_file_with_black_ink(
-                self.inpainted_file, self.png_of_svg_file, self.dest_upscayled_restored_file
+            out_image = overlay_inpainted_image_with_black_ink(
+                self._get_image(self.inpainted_file),
+                self._get_image(self.ink_mask_file, cv.IMREAD_UNCHANGED),
             )
+            self._put_image(self.dest_upscayled_restored_file, out_image, True)
 
             logging.info(
                 f'Time taken to overlay inpainted file "{os.path.basename(self.inpainted_file)}":'
                 f" {int(time.time() - start)}s."
             )
+
+            self._set_stage_done(STAGE_OVERLAY)
         except Exception as e:
             self.errors_occurred = True
             logging.exception(e)
 
+    @_traced_stage(STAGE_RESIZE)
     def do_resize_restored_file(self):
+        if self._skip_stage(STAGE_RESIZE):
+            return
+
         try:
-            logging.info(f'\nResizing restored file to "{self.dest_restored_file}"...')
+            self._set_stage_started(STAGE_RESIZE)
 
-            # TODO: Save other params used in process.
-            restored_file_metadata = {
-                "Source file": f'"{get_clean_path(self.srce_file)}"',
-                "Upscayl file": f'"{get_clean_path(self.srce_upscale_file)}"',
-                "Upscayl scale": str(self.scale),
-            }
+            logging.info(f'\nResizing restored file to "{self.dest_restored_file}"...')
 
-            resize_image_file(
-                self.dest_upscayled_restored_file,
+            # The overlay result is still in memory unless the overlay stage was skipped.
+            write_resized_image_file(
+                self._get_image(self.dest_upscayled_restored_file),
                 self.scale,
                 self.dest_restored_file,
-                restored_file_metadata,
+                self._get_restored_file_metadata(),
             )
+
+            self._set_stage_done(STAGE_RESIZE)
         except Exception as e:
             self.errors_occurred = True
             logging.exception(e)
@@ -249,12 +693,9 @@ def check_file_exists(proc: RestorePipeline, file: Union[str, Path]):
 
 def check_for_errors(restore_procs: List[RestorePipeline]):
     for proc in restore_procs:
-        check_file_exists(proc, proc.removed_artifacts_file)
-        check_file_exists(proc, proc.removed_colors_file)
-        check_file_exists(proc, proc.smoothed_removed_colors_file)
+        for work_file in proc.get_persisted_work_files():
+            check_file_exists(proc, work_file)
         check_file_exists(proc, proc.dest_svg_restored_file)
-        check_file_exists(proc, proc.png_of_svg_file)
-        check_file_exists(proc, proc.inpainted_file)
         check_file_exists(proc, proc.dest_upscayled_restored_file)
         check_file_exists(proc, proc.dest_restored_file)
 
@@ -1,21 +1,34 @@
-from .gmic_exe import run_gmic
+from typing import List
+
+import cv2 as cv
+
+from .gmic_exe import run_gmic, run_gmic_on_images
 
 
 def smooth_image_file(in_file: str, out_file: str):
-    smooth_cmd = [
-        in_file,
+    smooth_cmd = [in_file] + _get_gmic_smooth_cmd() + ["-output[-1]", out_file]
+
+    run_gmic(smooth_cmd)
+
+
+def smooth_image(image: cv.typing.MatLike) -> cv.typing.MatLike:
+    # Any alpha channel is dropped, the same as for the color removed png file.
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = cv.cvtColor(image, cv.COLOR_BGRA2BGR)
+
+    return run_gmic_on_images(_get_gmic_smooth_cmd(), [image])
+
+
+def _get_gmic_smooth_cmd() -> List[str]:
+    return [
         "fx_smooth_anisotropic",
         _get_gmic_smooth_anisotropic_params(),
         "-threshold[-1]",
         "100,1",
         "normalize[-1]",
         "0,255",
-        "-output[-1]",
-        out_file,
     ]
 
-    run_gmic(smooth_cmd)
-
 
 def _get_gmic_smooth_anisotropic_params() -> str:
     amplitude = 420
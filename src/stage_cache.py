@@ -0,0 +1,100 @@
+import hashlib
+import inspect
+import json
+import os
+from functools import lru_cache
+from types import ModuleType
+from typing import Any, Callable, Dict, List, Optional
+
+# Bump this to invalidate every stage cache entry.
+STAGE_CACHE_VERSION = 1
+
+FILE_HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# Records, per stage, the key the stage's outputs were last made with. A stage key is a hash
+# of the stage's input keys (file contents or upstream stage keys), its parameters and the
+# source code of the modules that implement it. The cache is a small json file so stages
+# run in different processes see each other's entries.
+class StageCache:
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+
+    def get_stage_key(self, stage: str) -> Optional[str]:
+        return self._load()["stages"].get(stage)
+
+    def set_stage_key(self, stage: str, key: str):
+        cache = self._load()
+        cache["stages"][stage] = key
+        self._save(cache)
+
+    def remove_stage_key(self, stage: str):
+        cache = self._load()
+        if cache["stages"].pop(stage, None) is not None:
+            self._save(cache)
+
+    # Content hashes of large files are remembered against their size and modification
+    # time so unchanged files are not hashed again.
+    def get_file_key(self, file: str) -> str:
+        stat = os.stat(file)
+        cache = self._load()
+
+        file_entry = cache["files"].get(file)
+        if (
+            file_entry
+            and file_entry["size"] == stat.st_size
+            and file_entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return file_entry["key"]
+
+        key = get_file_content_key(file)
+        cache["files"][file] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "key": key}
+        self._save(cache)
+
+        return key
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        cache = {"stages": dict(), "files": dict()}
+        if os.path.isfile(self.cache_file):
+            with open(self.cache_file, "r") as f:
+                cache.update(json.load(f))
+
+        return cache
+
+    def _save(self, cache: Dict[str, Dict[str, Any]]):
+        temp_file = self.cache_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(cache, f, indent=4)
+        os.replace(temp_file, self.cache_file)
+
+
+def get_stage_key(
+    stage: str, input_keys: List[str], params: Dict[str, Any], stage_funcs: List[Callable]
+) -> str:
+    key_hash = hashlib.sha256()
+
+    key_hash.update(f"{stage}:{STAGE_CACHE_VERSION}".encode())
+    for input_key in input_keys:
+        key_hash.update(input_key.encode())
+    key_hash.update(json.dumps(params, sort_keys=True, default=str).encode())
+    for func in stage_funcs:
+        key_hash.update(get_code_key(inspect.getmodule(func)).encode())
+
+    return key_hash.hexdigest()
+
+
+def get_file_content_key(file: str) -> str:
+    file_hash = hashlib.sha256()
+
+    with open(file, "rb") as f:
+        while chunk := f.read(FILE_HASH_CHUNK_SIZE):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+# Stage parameters are mostly module constants, so the module source covers those
+# as well as the code itself.
+@lru_cache(maxsize=None)
+def get_code_key(module: ModuleType) -> str:
+    return hashlib.sha256(inspect.getsource(module).encode()).hexdigest()
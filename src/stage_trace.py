@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+import psutil
+
+from .memory_admission import PeakRssSampler
+
+# Set to False to turn off stage tracing even when a trace file is given.
+USE_STAGE_TRACE = True
+
+TRACE_PROCESS_NAME = "barks-restore"
+
+
+# Record wall time, cpu time, peak memory and io of the code run in the 'with' block as one
+# json line appended to 'trace_file'. The cpu time includes finished child processes (gmic,
+# upscayl, etc.) and so does the io on linux, which adds reaped children's io to the parent.
+# Lines are written with a single append so processes can share the trace file. The caller
+# can add its own fields to the yielded record.
+@contextmanager
+def trace_stage(trace_file: str, stage: str, page: str) -> Iterator[Dict[str, Any]]:
+    record: Dict[str, Any] = dict()
+    if not trace_file or not USE_STAGE_TRACE:
+        yield record
+        return
+
+    process = psutil.Process()
+    start_time = time.time()
+    start_wall = time.perf_counter()
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_io = _get_io_counters(process)
+
+    sampler = PeakRssSampler()
+    try:
+        with sampler:
+            yield record
+    except BaseException:
+        record["ok"] = False
+        raise
+    finally:
+        record.setdefault("ok", True)
+        wall_secs = time.perf_counter() - start_wall
+        end_self = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        end_io = _get_io_counters(process)
+
+        record |= {
+            "stage": stage,
+            "page": page,
+            "pid": os.getpid(),
+            "start": start_time,
+            "wall_secs": wall_secs,
+            "cpu_user_secs": end_self.ru_utime - start_self.ru_utime,
+            "cpu_sys_secs": end_self.ru_stime - start_self.ru_stime,
+            "child_cpu_user_secs": end_children.ru_utime - start_children.ru_utime,
+            "child_cpu_sys_secs": end_children.ru_stime - start_children.ru_stime,
+            "peak_rss": sampler.peak_rss,
+            "peak_rss_growth": sampler.peak_rss_growth,
+        }
+        for key in end_io:
+            record[key] = end_io[key] - start_io[key]
+
+        # Don't let a trace write failure fail the stage, or hide the stage's own exception.
+        try:
+            _append_line(trace_file, json.dumps(record))
+        except OSError as e:
+            logging.error(f'Could not write to stage trace file "{trace_file}": {e}')
+
+
+def _get_io_counters(process: psutil.Process) -> Dict[str, int]:
+    # Not available on macOS.
+    if not hasattr(process, "io_counters"):
+        return dict()
+
+    io = process.io_counters()
+    counters = {"read_bytes": io.read_bytes, "write_bytes": io.write_bytes}
+    # Linux also counts bytes read and written through the page cache.
+    if hasattr(io, "read_chars"):
+        counters["read_chars"] = io.read_chars
+        counters["write_chars"] = io.write_chars
+
+    return counters
+
+
+def _append_line(file: str, line: str):
+    fd = os.open(file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (line + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+def read_trace_file(trace_file: str) -> List[Dict[str, Any]]:
+    with open(trace_file, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Convert a json lines trace to the chrome trace event format, which can be loaded in
+# chrome://tracing or https://ui.perfetto.dev. Each worker process gets its own timeline.
+def write_chrome_trace(trace_file: str, chrome_trace_file: str):
+    records = read_trace_file(trace_file)
+    run_start = min((record["start"] for record in records), default=0.0)
+
+    events = [
+        {
+            "name": "process_name",
+            "ph": "M",
+            "pid": 1,
+            "args": {"name": TRACE_PROCESS_NAME},
+        }
+    ]
+    for pid in sorted({record["pid"] for record in records}):
+        events.append(
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": pid, "args": {"name": f"{pid}"}}
+        )
+
+    for record in records:
+        args = {key: value for key, value in record.items() if key not in ["stage", "start"]}
+        events.append(
+            {
+                "name": record["stage"],
+                "cat": record["page"],
+                "ph": "X",
+                "ts": int((record["start"] - run_start) * 1e6),
+                "dur": int(record["wall_secs"] * 1e6),
+                "pid": 1,
+                "tid": record["pid"],
+                "args": args,
+            }
+        )
+
+    with open(chrome_trace_file, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
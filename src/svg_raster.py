@@ -0,0 +1,172 @@
+import concurrent.futures
+import os
+import re
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+import cairosvg
+import numpy as np
+from cairosvg.parser import Tree
+from cairosvg.surface import PNGSurface
+from PIL import Image
+
+from .tiling import Strip, get_strips
+
+# Pages are taken straight from the cairo surface into the page buffer, rather than through
+# png bytes and PIL. Big svgs can also be rendered as horizontal bands in parallel
+# processes, each band an svg with the same content and a viewBox over just its rows.
+# Workers are only sent the band geometry, and read and patch the svg themselves. But
+# every band parses and walks the whole svg, so the bands cost about as much cpu each as
+# the whole page (see 'benchmarks/svg_backend_benchmark.py'). Render many files as whole
+# pages in parallel instead.
+USE_BANDED_SVG_RASTER = False
+SVG_RASTER_BAND_HEIGHT = 1024
+SVG_RASTER_WORKERS = os.cpu_count()
+SVG_DPI = 96
+
+SVG_TAG_REGEX = re.compile(r"<svg\b([^>]*)>")
+SVG_ATTRIBUTE_REGEX = re.compile(r'([\w:-]+)="([^"]*)"')
+SVG_PIXEL_LENGTH_REGEX = re.compile(r"\s*(\d+(?:\.\d*)?)\s*(?:px)?\s*")
+# A band viewBox must have the page's aspect ratio for the bands to line up.
+MAX_VIEWBOX_ASPECT_DIFF = 1e-6
+
+
+# Returns an RGBA image.
+def get_svg_image(
+    svg_file: str, num_workers: int = SVG_RASTER_WORKERS, use_bands: bool = USE_BANDED_SVG_RASTER
+) -> np.ndarray:
+    page_geometry = _get_svg_file_page_geometry(svg_file)
+    if page_geometry is None:
+        return _get_whole_svg_image(svg_file)
+
+    width, height, viewbox = page_geometry
+    # Unless banding, the page is one band, so the svg is parsed just once.
+    band_height = SVG_RASTER_BAND_HEIGHT if use_bands and num_workers > 1 else height
+    bands = list(get_strips(height, 0, band_height))
+    band_args = [(svg_file, width, height, viewbox, band) for band in bands]
+
+    image = np.empty((height, width, 4), dtype=np.uint8)
+
+    if len(bands) == 1:
+        for band, args in zip(bands, band_args):
+            image[band.start : band.end] = _get_band_image(*args)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(min(num_workers, len(bands))) as executor:
+            for band, band_image in zip(bands, executor.map(_get_band_image, *zip(*band_args))):
+                image[band.start : band.end] = band_image
+
+    return image
+
+
+def _get_whole_svg_image(svg_file: str) -> np.ndarray:
+    png_image = cairosvg.svg2png(url=svg_file, scale=1, background_color=None)
+
+    with Image.open(BytesIO(png_image)) as pil_image:
+        return np.asarray(pil_image.convert("RGBA"))
+
+
+def _get_svg_file_page_geometry(
+    svg_file: str,
+) -> Optional[Tuple[int, int, Optional[Tuple[float, float, float, float]]]]:
+    with open(svg_file, "r") as f:
+        return _get_page_geometry(f.read())
+
+
+# Pixel width and height and any viewBox, or None if the svg can't be banded.
+def _get_page_geometry(
+    svg: str,
+) -> Optional[Tuple[int, int, Optional[Tuple[float, float, float, float]]]]:
+    svg_tag = SVG_TAG_REGEX.search(svg)
+    if not svg_tag:
+        return None
+    attributes = _get_attributes(svg_tag.group(1))
+
+    width = SVG_PIXEL_LENGTH_REGEX.fullmatch(attributes.get("width", ""))
+    height = SVG_PIXEL_LENGTH_REGEX.fullmatch(attributes.get("height", ""))
+    if not width or not height:
+        return None
+    width = int(round(float(width.group(1))))
+    height = int(round(float(height.group(1))))
+    if width == 0 or height == 0:
+        return None
+
+    if "viewBox" not in attributes:
+        return width, height, None
+
+    viewbox = tuple(float(v) for v in re.split(r"[\s,]+", attributes["viewBox"].strip()))
+    if len(viewbox) != 4 or viewbox[2] <= 0 or viewbox[3] <= 0:
+        return None
+    if abs(viewbox[2] / viewbox[3] - width / height) > MAX_VIEWBOX_ASPECT_DIFF * width / height:
+        return None
+
+    return width, height, viewbox
+
+
+def _get_band_svg(
+    svg: str,
+    width: int,
+    height: int,
+    viewbox: Optional[Tuple[float, float, float, float]],
+    band: Strip,
+) -> str:
+    band_height = band.end - band.start
+    if viewbox is None:
+        band_viewbox = (0, band.start, width, band_height)
+    else:
+        units_per_pixel = viewbox[3] / height
+        band_viewbox = (
+            viewbox[0],
+            viewbox[1] + band.start * units_per_pixel,
+            viewbox[2],
+            band_height * units_per_pixel,
+        )
+
+    svg_tag = SVG_TAG_REGEX.search(svg)
+    attributes = _get_attributes(svg_tag.group(1))
+    attributes["width"] = str(width)
+    attributes["height"] = str(band_height)
+    attributes["viewBox"] = " ".join(str(v) for v in band_viewbox)
+    attributes["preserveAspectRatio"] = "none"
+    band_svg_tag = "<svg " + " ".join(f'{name}="{value}"' for name, value in attributes.items())
+
+    return svg[: svg_tag.start()] + band_svg_tag + ">" + svg[svg_tag.end() :]
+
+
+def _get_attributes(tag_contents: str) -> Dict[str, str]:
+    return {name: value for name, value in SVG_ATTRIBUTE_REGEX.findall(tag_contents)}
+
+
+def _get_band_image(
+    svg_file: str,
+    width: int,
+    height: int,
+    viewbox: Optional[Tuple[float, float, float, float]],
+    band: Strip,
+) -> np.ndarray:
+    with open(svg_file, "r") as f:
+        band_svg = _get_band_svg(f.read(), width, height, viewbox, band)
+
+    # The svg file is only for resolving any relative references.
+    surface = PNGSurface(Tree(bytestring=band_svg.encode(), url=svg_file), None, SVG_DPI).cairo
+    surface.flush()
+
+    width = surface.get_width()
+    height = surface.get_height()
+    data = np.frombuffer(surface.get_data(), dtype=np.uint8)
+    bgra = data.reshape(height, surface.get_stride())[:, : 4 * width].reshape(height, width, 4)
+
+    return _get_unpremultiplied_rgba(bgra)
+
+
+# Cairo's ARGB32 is premultiplied, and B, G, R, A in memory on little endian machines.
+# Unpremultiply with the same rounding as cairo's png writer.
+def _get_unpremultiplied_rgba(bgra: np.ndarray) -> np.ndarray:
+    alpha = bgra[:, :, 3:4].astype(np.uint32)
+    color = bgra[:, :, 2::-1].astype(np.uint32)
+    color = np.where(alpha == 0, 0, (color * 255 + alpha // 2) // np.maximum(alpha, 1))
+
+    rgba = np.empty_like(bgra)
+    rgba[:, :, :3] = color
+    rgba[:, :, 3] = bgra[:, :, 3]
+
+    return rgba
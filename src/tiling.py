@@ -0,0 +1,81 @@
+from typing import Callable, Iterator, List, NamedTuple, Optional
+
+import cv2 as cv
+
+# Process full page images as horizontal strips so the temporary buffers each stage
+# needs are bounded by the strip size rather than the page size. Strips are row
+# slices, so they are views (no copies) of the page images. Only the working set is
+# bounded: the page images themselves are still whole pages. Work file inputs are
+# memory mapped, and a stage output that is persisted as a work file is written through
+# a memory mapped file, so those pages are file backed and can be dropped from memory
+# under pressure, but the upscayled input, deliverable outputs and the stages that
+# don't run in strips (smoothing, tracing, inpainting) hold whole pages.
+USE_TILED_STAGES = True
+STRIP_HEIGHT = 1024
+
+
+class Strip(NamedTuple):
+    start: int
+    end: int
+    halo_start: int
+    halo_end: int
+
+
+def get_strips(image_height: int, halo: int, strip_height: int = STRIP_HEIGHT) -> Iterator[Strip]:
+    if not USE_TILED_STAGES or strip_height <= 0:
+        strip_height = image_height
+
+    for start in range(0, image_height, strip_height):
+        end = min(start + strip_height, image_height)
+        yield Strip(start, end, max(0, start - halo), min(image_height, end + halo))
+
+
+# Run 'func' on matching strips (plus 'halo' rows above and below) of each of the
+# 'in_images' and stitch the strip results, less their halos, into 'out_image'.
+# The halo must cover the reach of every kernel 'func' applies so that the strip
+# results are identical to running 'func' on the full images. If 'out_image' is
+# None then 'func' is assumed to work in place on its strips.
+def apply_in_strips(
+    func: Callable[..., Optional[cv.typing.MatLike]],
+    in_images: List[cv.typing.MatLike],
+    out_image: Optional[cv.typing.MatLike] = None,
+    halo: int = 0,
+    strip_height: int = STRIP_HEIGHT,
+) -> None:
+    image_height = in_images[0].shape[0]
+    for image in in_images:
+        assert image.shape[0] == image_height
+
+    for strip in get_strips(image_height, halo, strip_height):
+        strip_out = func(*[image[strip.halo_start : strip.halo_end] for image in in_images])
+
+        if out_image is not None:
+            core_start = strip.start - strip.halo_start
+            core_end = strip.end - strip.halo_start
+            out_image[strip.start : strip.end] = strip_out[core_start:core_end]
+
+
+# A rectangle of a page, end exclusive - for work that is split both ways, such as
+# tracing, rather than into strips.
+class Tile(NamedTuple):
+    x0: int
+    y0: int
+    x1: int
+    y1: int
+
+
+def get_tiles(width: int, height: int, tile_size: int) -> List[Tile]:
+    return [
+        Tile(x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+        for y0 in range(0, height, tile_size)
+        for x0 in range(0, width, tile_size)
+    ]
+
+
+def get_expanded_tile(tile: Tile, margin: int, width: int, height: int) -> Tile:
+    return Tile(
+        max(0, tile.x0 - margin),
+        max(0, tile.y0 - margin),
+        min(width, tile.x1 + margin),
+        min(height, tile.y1 + margin),
+    )
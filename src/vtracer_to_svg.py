@@ -1,43 +1,171 @@
+import concurrent.futures
 import os.path
+import re
+import time
+from typing import List, NamedTuple, Tuple
 
-from vtracer import convert_image_to_svg_py
+import cv2 as cv
+import numpy as np
+from vtracer import convert_image_to_svg_py, convert_raw_image_to_svg
 
+from .ink_mask import get_ink_mask_from_svg
+from .tiling import Tile, get_expanded_tile, get_tiles
+
+# colormode (str, optional): True color image `color` (default) or Binary image `binary`.
+# color_precision (int, optional): Number of significant bits to use in an RGB channel.
+#                                  Defaults to 8.
+# layer_difference (int, optional): Color difference between gradient layers. Defaults to 16.
+# hierarchical (str, optional): Hierarchical clustering. Can be `stacked` (default) or
+#                               non-stacked `cutout`. Only applies to color mode.
+# path_precision (int, optional): Parameter not described in provided options. Defaults to 8.
+# mode (str, optional): Curve fitting mode. Can be `pixel`, `polygon`, `spline`.
+#                       Defaults to 'spline'.
+# corner_threshold (int, optional): Minimum momentary angle (degree) to be considered a corner.
+#                                   Defaults to 60.
+# length_threshold (float, optional): Perform iterative subdivide smooth until all segments are
+#                                     shorter than this length. Defaults to 4.0.
+# max_iterations (int, optional): Parameter not described in provided options. Defaults to 10.
+# splice_threshold (int, optional): Minimum angle displacement (degree) to splice a spline.
+#                                   Defaults to 45.
+# filter_speckle (int, optional): Discard patches smaller than X px in size. Defaults to 4.
+
+# Testing on three single panel images showed defaults good but 'length_threshold=10' also
+# gives good results with smaller .svg files.
+VTRACER_PARAMS = dict(
+    colormode="binary",
+    path_precision=3,
+    mode="spline",
+    filter_speckle=2,
+    corner_threshold=60,
+    length_threshold=10.0,
+    max_iterations=10,
+    splice_threshold=45,  # higher than this is not so good
+)
+
+
+# Big pages can be traced as tiles in parallel processes. Each tile is traced with this much
+# of its neighbours around it and its paths clipped back to the tile, so shapes crossing
+# a seam are traced whole on both sides of it and the clipped pieces meet at the seam.
+# vtracer's curve fitting still differs a little near the seams (0.1-0.3% of the ink
+# pixels on test pages), so it's off unless the speed is worth that.
+USE_TILED_TRACING = False
+TRACE_TILE_SIZE = 2048
+TRACE_TILE_OVERLAP = 64
+TRACE_WORKERS = os.cpu_count()
+
+SVG_PATH_ELEMENT_REGEX = re.compile(r"<path\b[^>]*>")
+
+
+class VtracerSvg(NamedTuple):
+    svg: str
+    num_paths: int
+    trace_secs: float
 
-def image_file_to_svg(in_file: str, out_file: str):
 
-    # colormode (str, optional): True color image `color` (default) or Binary image `binary`.
-    # color_precision (int, optional): Number of significant bits to use in an RGB channel.
-    #                                  Defaults to 8.
-    # layer_difference (int, optional): Color difference between gradient layers. Defaults to 16.
-    # hierarchical (str, optional): Hierarchical clustering. Can be `stacked` (default) or
-    #                               non-stacked `cutout`. Only applies to color mode.
-    # path_precision (int, optional): Parameter not described in provided options. Defaults to 8.
-    # mode (str, optional): Curve fitting mode. Can be `pixel`, `polygon`, `spline`.
-    #                       Defaults to 'spline'.
-    # corner_threshold (int, optional): Minimum momentary angle (degree) to be considered a corner.
-    #                                   Defaults to 60.
-    # length_threshold (float, optional): Perform iterative subdivide smooth until all segments are
-    #                                     shorter than this length. Defaults to 4.0.
-    # max_iterations (int, optional): Parameter not described in provided options. Defaults to 10.
-    # splice_threshold (int, optional): Minimum angle displacement (degree) to splice a spline.
-    #                                   Defaults to 45.
-    # filter_speckle (int, optional): Discard patches smaller than X px in size. Defaults to 4.
-
-    # Testing on three single panel images showed defaults good but 'length_threshold=10' also
-    # gives good results with smaller .svg files.
+class TiledVtracerSvg(NamedTuple):
+    svg: str
+    num_paths: int
+    trace_secs: float
+    ink_mask: np.ndarray
 
+
+def image_file_to_svg(in_file: str, out_file: str):
     if not os.path.isfile(in_file):
         raise Exception(f'Could not find file "{in_file}".')
 
-    convert_image_to_svg_py(
-        in_file,
-        out_file,
-        colormode="binary",
-        path_precision=3,
-        mode="spline",
-        filter_speckle=2,
-        corner_threshold=60,
-        length_threshold=10.0,
-        max_iterations=10,
-        splice_threshold=45,  # higher than this is not so good
+    convert_image_to_svg_py(in_file, out_file, **VTRACER_PARAMS)
+
+
+# Trace an in memory image - the same as 'image_file_to_svg' but without the image and svg
+# files. A bool image is taken as True for ink. The image is handed to vtracer as an
+# uncompressed bmp, which it decodes to the same pixels as a png.
+def image_to_svg(image: cv.typing.MatLike) -> VtracerSvg:
+    start = time.perf_counter()
+
+    if image.dtype == bool:
+        image = np.where(image, 0, 255).astype(np.uint8)
+
+    is_encoded, bmp_bytes = cv.imencode(".bmp", image)
+    if not is_encoded:
+        raise Exception("Could not encode the image as a bmp.")
+
+    svg = convert_raw_image_to_svg(bmp_bytes.tobytes(), "bmp", **VTRACER_PARAMS)
+
+    return VtracerSvg(svg, svg.count("<path"), time.perf_counter() - start)
+
+
+def get_trace_tiles(width: int, height: int) -> List[Tile]:
+    if not USE_TILED_TRACING:
+        return [Tile(0, 0, width, height)]
+
+    return get_tiles(width, height, TRACE_TILE_SIZE)
+
+
+# Trace 'tiles' of the image in parallel and join their paths into one svg, each tile's
+# paths in a group clipped to the tile. The tiles can be any rectangles that don't overlap -
+# anything outside them is left blank - and they're traced in the order given. The ink mask
+# is rasterized from each tile's own svg as it's traced, so the joined svg doesn't have to
+# be read back.
+def image_to_svg_in_tiles(
+    image: cv.typing.MatLike,
+    tiles: List[Tile],
+    overlap: int = TRACE_TILE_OVERLAP,
+    num_workers: int = TRACE_WORKERS,
+) -> TiledVtracerSvg:
+    start = time.perf_counter()
+
+    height, width = image.shape[:2]
+    traced_tiles = [get_expanded_tile(tile, overlap, width, height) for tile in tiles]
+    tile_args = [
+        (
+            image[traced.y0 : traced.y1, traced.x0 : traced.x1],
+            Tile(
+                tile.x0 - traced.x0, tile.y0 - traced.y0, tile.x1 - traced.x0, tile.y1 - traced.y0
+            ),
+        )
+        for tile, traced in zip(tiles, traced_tiles)
+    ]
+
+    if len(tiles) <= 1 or num_workers == 1:
+        tile_results = [_trace_tile(*args) for args in tile_args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(min(num_workers, len(tiles))) as executor:
+            tile_results = list(executor.map(_trace_tile, *zip(*tile_args)))
+
+    ink_mask = np.zeros((height, width), dtype=np.uint8)
+    clip_paths = []
+    groups = []
+    num_paths = 0
+    for i, (tile, traced, (paths, tile_mask)) in enumerate(zip(tiles, traced_tiles, tile_results)):
+        ink_mask[tile.y0 : tile.y1, tile.x0 : tile.x1] = tile_mask
+        if not paths:
+            continue
+
+        clip_paths.append(
+            f'<clipPath id="tile-{i}"><rect x="{tile.x0}" y="{tile.y0}"'
+            f' width="{tile.x1 - tile.x0}" height="{tile.y1 - tile.y0}"/></clipPath>\n'
+        )
+        groups.append(
+            f'<g clip-path="url(#tile-{i})"><g transform="translate({traced.x0},{traced.y0})">\n'
+            + "\n".join(paths)
+            + "\n</g></g>\n"
+        )
+        num_paths += len(paths)
+
+    svg = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<svg version="1.1" xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">\n'
+        f'<defs>\n{"".join(clip_paths)}</defs>\n'
+        f'{"".join(groups)}'
+        "</svg>\n"
     )
+
+    return TiledVtracerSvg(svg, num_paths, time.perf_counter() - start, ink_mask)
+
+
+def _trace_tile(tile_image: cv.typing.MatLike, core: Tile) -> Tuple[List[str], np.ndarray]:
+    vtracer_svg = image_to_svg(tile_image)
+    paths = SVG_PATH_ELEMENT_REGEX.findall(vtracer_svg.svg)
+    ink_mask = get_ink_mask_from_svg(vtracer_svg.svg)
+
+    return paths, ink_mask[core.y0 : core.y1, core.x0 : core.x1].copy()